@@ -1,31 +1,25 @@
 from pathlib import Path
 
-import aiofiles
 from tqdm import tqdm
 
-from dynabook_scraper.utils import json
-from dynabook_scraper.utils.common import download_file, run_concurrently
-from dynabook_scraper.utils.paths import content_dir, data_dir, downloads_dir
+from dynabook_scraper.utils import state
+from dynabook_scraper.utils.download import download_file
+from dynabook_scraper.utils.pool import WorkerPool
+from dynabook_scraper.utils.paths import data_dir, downloads_dir
 from dynabook_scraper.utils.uvloop import async_run
 
 
-async def process(file: Path):
-    if not file.is_file() or not file.name.endswith("_crawl_result.json"):
+async def process(j: dict):
+    if "actual_size" in j:
         return
 
-    content_id = file.name.split("_")[0]
-
-    async with aiofiles.open(file) as f:
-        j = await json.aload(f)
-
-        if "actual_size" in j:
-            return
-
-        tqdm.write(str(j))
+    tqdm.write(str(j))
 
     if j["status_code"] != 200:
         return
 
+    content_id = str(j["contentID"])
+
     if "rescue_strategy" in j:
         filename = Path(j["original_url"]).name
         mirror_filename = Path(j["mirror_url"]).name
@@ -50,8 +44,7 @@ async def process(file: Path):
 
     if not path.is_file():
         if not "rescue_strategy" in j:
-            async with aiofiles.open(content_dir / f"{content_id}.json") as f:
-                cj = await json.aload(f)
+            cj = state.get_details(content_id)
             await download_file(cj["contentFile"], downloads_dir / content_id)
 
     try:
@@ -59,12 +52,11 @@ async def process(file: Path):
     except FileNotFoundError:
         breakpoint()
 
-    async with aiofiles.open(file, "w") as f:
-        await json.adump(j, f)
+    state.put_result(j)
 
 
 async def main():
-    await run_concurrently(20, process, list(content_dir.iterdir()))
+    await WorkerPool(20, process).run(state.iter_results())
 
 
 async_run(main())
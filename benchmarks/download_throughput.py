@@ -0,0 +1,83 @@
+"""
+Measure the throughput of download_file against a local HTTP server.
+
+Usage: python benchmarks/download_throughput.py [size_mb] [concurrency]
+
+The server runs in a separate process so that only the client side is accounted for. Besides the wall-clock
+throughput, the benchmark reports MB/s per CPU-second spent by the client, which is what limits us when many
+downloads run in parallel. The legacy row reproduces the old 1 KiB aiofiles write loop for comparison.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="dynabook-bench-"))
+os.environ.setdefault("TQDM_DISABLE", "1")
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import aiofiles
+from aiohttp import web
+
+from dynabook_scraper.utils import http
+from dynabook_scraper.utils.download import download_file
+from dynabook_scraper.utils.uvloop import async_run
+
+PORT = 8931
+
+
+def serve(size: int):
+    payload = os.urandom(1024 * 1024) * (size // (1024 * 1024))
+
+    async def handler(_request):
+        return web.Response(body=payload, headers={"Content-Type": "application/octet-stream"})
+
+    app = web.Application()
+    app.router.add_get("/{name}", handler)
+    web.run_app(app, host="127.0.0.1", port=PORT, print=None, access_log=None)
+
+
+async def legacy_download(url: str, out_dir: Path):
+    async with http.get(url) as response:
+        async with aiofiles.open(out_dir / Path(url).name, "wb") as f:
+            async for chunk in response.content.iter_chunked(1024):
+                await f.write(chunk)
+
+
+async def run(download, size: int, concurrency: int, out_dir: Path) -> tuple[float, float]:
+    # Warm up the connection pool
+    await download(f"http://127.0.0.1:{PORT}/warmup.bin", out_dir)
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    await asyncio.gather(*(download(f"http://127.0.0.1:{PORT}/file{i}.bin", out_dir) for i in range(concurrency)))
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+    total_mb = size * concurrency / (1024 * 1024)
+    return total_mb / wall, total_mb / cpu
+
+
+def main():
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 256) * 1024 * 1024
+    concurrency = int(sys.argv[2] if len(sys.argv) > 2 else 8)
+
+    server = multiprocessing.Process(target=serve, args=(size,), daemon=True)
+    server.start()
+    time.sleep(1)
+
+    try:
+        print(f"{concurrency} concurrent downloads of {size // (1024 * 1024)} MiB")
+        print(f"{'engine':<10} {'MB/s':>10} {'MB/s per core':>15}")
+        for name, download in (("current", download_file), ("legacy", legacy_download)):
+            with tempfile.TemporaryDirectory() as out_dir:
+                throughput, per_core = async_run(run(download, size, concurrency, Path(out_dir)))
+            print(f"{name:<10} {throughput:>10.1f} {per_core:>15.1f}")
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""
+Local stand-in for support.dynabook.com, content.us.dynabook.com, the Memento timegate and archive.org.
+
+Usage: python benchmarks/fake_upstream.py [--port 8940] [--models 50] [--latency 20] [--error-rate 0.01] ...
+
+Point the scraper at it with HTTP_UPSTREAM_OVERRIDE=http://127.0.0.1:8940: requests to https://host/path are then
+served from /host/path. Everything is generated from --seed so runs are reproducible; with --recorded the responses
+stored in an http_cache.sqlite (see utils.http_cache) are served instead of synthetic ones whenever available.
+
+Request and byte counters are available at /__stats.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import sqlite3
+import zlib
+from dataclasses import dataclass
+
+from aiohttp import web
+
+DRIVER_BASE = 100000
+KB_BASE = 200000
+MANUAL_BASE = 300000
+LINKED_BASE = 400000
+VERSION_BASE = 500000
+
+
+@dataclass
+class Options:
+    seed: int = 0
+    models: int = 50
+    drivers_per_model: int = 8
+    max_file_size: int = 2 * 1024 * 1024
+    broken_rate: float = 0.1
+    latency: float = 0.02
+    error_rate: float = 0.0
+    drop_rate: float = 0.0
+
+
+class FakeUpstream:
+    def __init__(self, options: Options, recorded: str | None = None):
+        self.options = options
+        self.rng = random.Random(options.seed)
+        self.requests = 0
+        self.bytes_sent = 0
+        self.recorded = sqlite3.connect(recorded) if recorded else None
+        self.block = random.Random(options.seed).randbytes(1024 * 1024)
+        self._build_catalog()
+
+    def _build_catalog(self):
+        o = self.options
+        self.driver_pool = [str(DRIVER_BASE + i) for i in range(o.models * 3)]
+        self.models = {}
+        for m in range(o.models):
+            mid = str(1000 + m)
+            rng = random.Random(f"{o.seed}-model-{mid}")
+            self.models[mid] = {
+                "mid": mid,
+                "mname": f"Satellite {mid}",
+                "drivers": rng.sample(self.driver_pool, min(o.drivers_per_model, len(self.driver_pool))),
+                "kb": [str(KB_BASE + rng.randrange(o.models * 2)) for _ in range(3)],
+                "manuals": [str(MANUAL_BASE + rng.randrange(o.models)) for _ in range(2)],
+            }
+
+    def _content_rng(self, cid: str) -> random.Random:
+        return random.Random(f"{self.options.seed}-content-{cid}")
+
+    def file_size(self, cid: str) -> int:
+        rng = self._content_rng(cid)
+        return max(1024, min(self.options.max_file_size, int(rng.lognormvariate(11, 1.5))))
+
+    def is_broken(self, cid: str) -> bool:
+        return self._content_rng(cid).random() < self.options.broken_rate
+
+    # Pages
+
+    def drivers_page(self) -> str:
+        products = {}
+        for i, model in enumerate(self.models.values()):
+            pid, fid = str(i % 2 + 1), str(i % 5 + 1)
+            product = products.setdefault(pid, {"pname": f"Product {pid}", "pimg": f"/images/p{pid}.png", "family": []})
+            family = next((f for f in product["family"] if f["fid"] == fid), None)
+            if not family:
+                family = {"fid": fid, "fname": f"Family {fid}", "fimg": f"/images/f{fid}.png", "models": []}
+                product["family"].append(family)
+            family["models"].append({"mid": model["mid"], "mname": model["mname"]})
+        return f"<html><script>var allProducts = eval({json.dumps(products)});</script></html>"
+
+    def model_page(self, mid: str, os_id: str | None) -> str:
+        model = self.models[mid]
+        os_list = [{"osId": "-1", "osNameAndType": "All"}, {"osId": "10", "osNameAndType": "Windows 10 64-bit"}]
+        drivers = [
+            {
+                "contentID": int(cid),
+                "contentType": "DL",
+                "sor": "undefined",
+                "title": f"Driver {cid}",
+                "tags": "10",
+                "tagNames": "Windows 10 64-bit",
+            }
+            for cid in model["drivers"]
+        ]
+        kb = [{"contentID": cid, "contentType": "SB", "title": f"Bulletin {cid}"} for cid in model["kb"]]
+        manuals = [
+            {"contentID": cid, "contentType": "UG" if int(cid) % 2 else "DS", "title": f"Manual {cid}"}
+            for cid in model["manuals"]
+        ]
+        factory = f"/support/viewFactoryConfig?mpn=P{mid}&config=CPU=Core i5, RAM=8GB"
+        return f"""<html><body>
+<div class="model_img"><img src="/images/models/{mid}.png"></div>
+<a href="{factory}">Factory configuration</a>
+<script>
+var partNumOSJSONArr = eval({json.dumps(os_list)});
+var manualsSpecsJsonArr = eval({json.dumps(manuals)});
+var knowledgeBaseJsonArr = eval({json.dumps(kb)});
+var driversUpdatesJsonArr = eval({json.dumps(drivers if os_id else [])});
+</script></body></html>"""
+
+    def content_detail(self, cid: str, content_type: str) -> dict:
+        rng = self._content_rng(cid)
+        filename = f"file_{cid}.{'pdf' if content_type == 'UG' else 'exe'}"
+        linked = LINKED_BASE + rng.randrange(self.options.models)
+        detail = {
+            "contentID": cid,
+            "contentType": content_type,
+            "title": f"Content {cid}",
+            "contentFile": f"https://content.us.dynabook.com/content/{cid}/{filename}",
+            "fileSize": self.file_size(cid),
+            "contentDetail": [
+                {
+                    "title": "Description",
+                    "content": (
+                        '<p>Details <img src="/images/support/banner.png">'
+                        f'<a href="https://support.dynabook.com/support/viewContentDetail?contentId={linked}">'
+                        "related</a></p>"
+                    ),
+                }
+            ],
+        }
+        if DRIVER_BASE <= int(cid) < KB_BASE and rng.random() < 0.2:
+            detail["contentVersion"] = [{"contentID": str(VERSION_BASE + int(cid) - DRIVER_BASE)}]
+        return detail
+
+    def static_content_detail(self, cid: str) -> str:
+        return (
+            f'<html><iframe type="application/pdf" '
+            f'src="https://content.us.dynabook.com/content/{cid}/static_{cid}.pdf"></iframe></html>'
+        )
+
+    # Serving
+
+    async def _send_file(self, request: web.Request, seed: str, size: int) -> web.StreamResponse:
+        start, end, status = 0, size - 1, 200
+        if range_header := request.headers.get("Range"):
+            first, _, last = range_header.removeprefix("bytes=").partition("-")
+            start = int(first or 0)
+            end = min(int(last), size - 1) if last else size - 1
+            if start >= size:
+                return web.Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+            status = 206
+
+        offset = int(hashlib.md5(seed.encode()).hexdigest(), 16) % len(self.block)
+        headers = {
+            "Content-Length": str(end - start + 1),
+            "Accept-Ranges": "bytes",
+            "ETag": f'"{seed}-{size}"',
+            "Content-Type": "application/octet-stream",
+        }
+        if status == 206:
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        if request.method == "HEAD":
+            await response.write_eof()
+            return response
+
+        drop_at = end + 1
+        if self.rng.random() < self.options.drop_rate:
+            drop_at = self.rng.randrange(start, end + 1)
+
+        pos = start
+        while pos <= end:
+            chunk_len = min(64 * 1024, end + 1 - pos)
+            block_pos = (offset + pos) % len(self.block)
+            chunk = (self.block[block_pos:] + self.block)[:chunk_len]
+            if pos + chunk_len > drop_at:
+                await response.write(chunk[: drop_at - pos])
+                request.transport.close()
+                return response
+            await response.write(chunk)
+            self.bytes_sent += chunk_len
+            pos += chunk_len
+        await response.write_eof()
+        return response
+
+    def _recorded(self, request: web.Request, host: str, path: str) -> web.Response | None:
+        if not self.recorded:
+            return None
+        url = f"https://{host}/{path}" + (f"?{request.query_string}" if request.query_string else "")
+        row = self.recorded.execute("SELECT status, content_type, body FROM responses WHERE url = ?", (url,)).fetchone()
+        if not row:
+            return None
+        status, content_type, body = row
+        return web.Response(status=status, body=zlib.decompress(body), headers={"Content-Type": content_type or ""})
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        host, path = request.match_info["host"], request.match_info["path"]
+        self.requests += 1
+        await asyncio.sleep(self.options.latency)
+
+        if self.rng.random() < self.options.error_rate:
+            return web.Response(status=429, headers={"Retry-After": "1"})
+
+        response = self._recorded(request, host, path) or await self._synthetic(request, host, path)
+        if isinstance(response, web.Response) and response.body is not None:
+            self.bytes_sent += len(response.body)
+        return response
+
+    async def _synthetic(self, request: web.Request, host: str, path: str) -> web.StreamResponse:
+        query = request.query
+
+        if host == "support.dynabook.com":
+            if path == "drivers":
+                return web.Response(text=self.drivers_page(), content_type="text/html")
+            if path == "support/modelHome" and query.get("freeText") in self.models:
+                return web.Response(
+                    text=self.model_page(query["freeText"], query.get("osId")), content_type="text/html"
+                )
+            if path == "support/contentDetail":
+                detail = self.content_detail(query["contentId"], query["contentType"])
+                return web.json_response(detail)
+            if path == "support/staticContentDetail":
+                return web.Response(text=self.static_content_detail(query["contentId"]), content_type="text/html")
+            if path.startswith("images/"):
+                return await self._send_file(request, path, 4096)
+
+        elif host == "content.us.dynabook.com" and path.startswith("content/"):
+            cid = path.split("/")[1]
+            if self.is_broken(cid):
+                raise web.HTTPNotFound()
+            return await self._send_file(request, path, self.file_size(cid))
+
+        elif host == "timetravel.mementoweb.org" and path.startswith("timegate/"):
+            original = path.removeprefix("timegate/")
+            cid = original.split("/content/")[-1].split("/")[0]
+            if int(cid) % 2:
+                raise web.HTTPFound(f"https://web.archive.org/web/2015/{original}")
+            raise web.HTTPNotFound()
+
+        elif host in ("web.archive.org", "archive.org") or host.endswith(".archive.org"):
+            cid = path.split("/content/")[-1].split("/")[0]
+            return await self._send_file(request, path, self.file_size(cid) if cid.isdigit() else 4096)
+
+        raise web.HTTPNotFound()
+
+    async def stats(self, _request: web.Request) -> web.Response:
+        return web.json_response({"requests": self.requests, "bytes": self.bytes_sent})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/__stats", self.stats)
+        app.router.add_route("*", "/{host}/{path:.*}", self.handle)
+        return app
+
+
+def main(args: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8940)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--models", type=int, default=50)
+    parser.add_argument("--max-file-size", type=int, default=2 * 1024 * 1024, help="in bytes")
+    parser.add_argument("--broken-rate", type=float, default=0.1, help="fraction of content files returning 404")
+    parser.add_argument("--latency", type=float, default=20, help="added latency per request, in milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="fraction of file transfers cut mid-way")
+    parser.add_argument("--recorded", help="http_cache.sqlite to serve recorded responses from")
+    ns = parser.parse_args(args)
+
+    options = Options(
+        seed=ns.seed,
+        models=ns.models,
+        max_file_size=ns.max_file_size,
+        broken_rate=ns.broken_rate,
+        latency=ns.latency / 1000,
+        error_rate=ns.error_rate,
+        drop_rate=ns.drop_rate,
+    )
+    web.run_app(FakeUpstream(options, ns.recorded).app(), host="127.0.0.1", port=ns.port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
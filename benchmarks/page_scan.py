@@ -0,0 +1,109 @@
+"""
+Compare the single-pass product page scanner (utils.page_scan) with the previous bs4 + per-variable regex path.
+
+Usage: python benchmarks/page_scan.py [--scraped] [--pages 200] [--filler-kb 150] [--rounds 3]
+
+By default the pages are generated by fake_upstream.py and padded with --filler-kb of navigation markup before the
+embedded variables, which is roughly what the real modelHome pages look like. Pass --scraped to use the pages scraped
+into $DATA_DIR instead. Both paths must extract the same values.
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import parse_qs
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="dynabook-bench-"))
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent))
+
+import bs4
+
+from dynabook_scraper.utils import html_pack, state
+from dynabook_scraper.utils.common import extract_json_var
+from dynabook_scraper.utils.page_scan import find_factory_config_url, find_model_img, load_json_var, scan_json_vars
+from fake_upstream import FakeUpstream, Options
+
+VARS = ("partNumOSJSONArr", "manualsSpecsJsonArr", "knowledgeBaseJsonArr", "driversUpdatesJsonArr")
+
+
+def legacy(page: bytes) -> tuple:
+    text = page.decode()
+    img = bs4.BeautifulSoup(text, "html.parser").select_one(".model_img img")
+    factory_config = None
+    for line in text.splitlines():
+        if "/support/viewFactoryConfig" in line:
+            factory_config = parse_qs(line.split('"')[1].split("?", 1)[1])
+            break
+    return img["src"] if img else None, factory_config, [extract_json_var(text, name) for name in VARS]
+
+
+def single_pass(page: bytes) -> tuple:
+    json_vars = scan_json_vars(page)
+    url = find_factory_config_url(page)
+    factory_config = parse_qs(url.split("?", 1)[1]) if url else None
+    return find_model_img(page), factory_config, [load_json_var(json_vars, name) for name in VARS]
+
+
+def synthetic_pages(count: int, filler_kb: int) -> list[bytes]:
+    upstream = FakeUpstream(Options(models=count, latency=0))
+    item = '<li class="nav-item"><a href="/support/category?id={0}" title="Category {0}">Category {0}</a></li>\n'
+    filler = "".join(item.format(i) for i in range(filler_kb * 1024 // len(item.format(0))))
+    pages = []
+    for mid in upstream.models:
+        page = upstream.model_page(mid, "10")
+        pages.append(page.replace("<body>", f"<body><ul class='nav'>\n{filler}</ul>", 1).encode())
+    return pages
+
+
+def scraped_pages(count: int) -> list[bytes]:
+    mids = sorted(state.html_page_positions("base.html"))[:count]
+
+    async def read():
+        return [await html_pack.read_page(mid, name) for mid in mids for name in html_pack.page_names(mid)]
+
+    return asyncio.run(read())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scraped", action="store_true", help="use the pages scraped into $DATA_DIR")
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--filler-kb", type=int, default=150)
+    parser.add_argument("--rounds", type=int, default=3)
+    ns = parser.parse_args()
+
+    if ns.scraped:
+        # base.html carries the other variables, os_*.html the drivers; scan both kinds
+        pages = scraped_pages(ns.pages)
+        pages = [page for page in pages if all(re.search(rf"var\s+{name}\b".encode(), page) for name in VARS)]
+    else:
+        pages = synthetic_pages(ns.pages, ns.filler_kb)
+    if not pages:
+        raise SystemExit("No page defines all of " + ", ".join(VARS))
+
+    for page in pages:
+        if legacy(page) != single_pass(page):
+            raise SystemExit("The single-pass scanner disagrees with the legacy path")
+
+    size = sum(map(len, pages)) / 1024**2
+    print(f"{len(pages)} pages, {size:.1f} MiB")
+    for name, func in (("legacy", legacy), ("single-pass", single_pass)):
+        best = min(_timed(func, pages) for _ in range(ns.rounds))
+        print(f"{name:<12} {best:>8.3f}s {len(pages) / best:>10.0f} pages/s {size / best:>8.1f} MiB/s")
+
+
+def _timed(func, pages: list[bytes]) -> float:
+    start = time.perf_counter()
+    for page in pages:
+        func(page)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main()
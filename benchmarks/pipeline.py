@@ -0,0 +1,154 @@
+"""
+Run every dynabook-* stage against the local fake upstream and report per-stage metrics.
+
+Usage: python benchmarks/pipeline.py [--data-dir DIR] [--stages a,b,...] [--orchestrated] [-- fake_upstream options]
+
+Each stage runs in its own process, in the same order as in the README, with a fresh data directory (unless
+--data-dir is given). For every stage the wall time, the number of requests and bytes served by the fake upstream
+and the peak RSS of the stage process are reported. With --orchestrated the whole pipeline is run by dynabook-run
+instead. Options after -- are passed to fake_upstream.py, e.g.
+``-- --models 200 --latency 50 --error-rate 0.02 --drop-rate 0.05``.
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tomllib
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+
+# (script, extra arguments), in pipeline order
+STAGES = [
+    ("dynabook-scrape-products-list", []),
+    ("dynabook-scrape-assets", []),
+    ("dynabook-scrape-products-html", []),
+    ("dynabook-parse-products-html", []),
+    ("dynabook-scrape-driver-contents", []),
+    ("dynabook-scrape-kb-contents", []),
+    ("dynabook-scrape-manuals-contents", []),
+    ("dynabook-scrape-content-links", []),
+    ("dynabook-download-contents", []),
+    ("dynabook-download-broken-links", []),
+    ("dynabook-gen-products-index", []),
+    ("dynabook-export-state", []),
+    ("dynabook-build-frontend", []),
+    ("dynabook-gen-sitemap", ["https://mirror.example"]),
+]
+# The same pipeline run by the orchestrator, in a single process
+ORCHESTRATED = [("dynabook-run", ["--sitemap", "https://mirror.example"])]
+
+
+def entry_points() -> dict[str, str]:
+    with open(ROOT / "pyproject.toml", "rb") as f:
+        return tomllib.load(f)["project"]["scripts"]
+
+
+def wait_for_port(port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Fake upstream did not start on port {port}")
+
+
+def upstream_stats(port: int) -> dict[str, int]:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/__stats") as response:
+        return json.load(response)
+
+
+def run_stage(script: str, target: str, args: list[str], env: dict[str, str], log) -> tuple[int, float, int]:
+    module, func = target.split(":")
+    code = f"import sys; sys.argv[0] = {script!r}; from {module} import {func}; {func}()"
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-c", code, *args], cwd=ROOT, env=env, stdout=log, stderr=log)
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in KiB on Linux
+    return process.returncode, time.perf_counter() - start, rusage.ru_maxrss * 1024
+
+
+def main():
+    argv = sys.argv[1:]
+    upstream_args = []
+    if "--" in argv:
+        upstream_args = argv[argv.index("--") + 1 :]
+        argv = argv[: argv.index("--")]
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-dir", help="run in this data directory instead of a temporary one")
+    parser.add_argument("--port", type=int, default=8940)
+    parser.add_argument("--stages", help="comma-separated list of stages to run (default: all)")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--orchestrated", action="store_true", help="run dynabook-run instead of each stage")
+    ns = parser.parse_args(argv)
+
+    data_dir = Path(ns.data_dir or tempfile.mkdtemp(prefix="dynabook-bench-"))
+    data_dir.mkdir(exist_ok=True, parents=True)
+    log_path = data_dir / "bench.log"
+
+    env = os.environ | {
+        "DATA_DIR": str(data_dir),
+        "HTTP_UPSTREAM_OVERRIDE": f"http://127.0.0.1:{ns.port}",
+        "TQDM_DISABLE": "1",
+        "PYTHONPATH": str(ROOT),
+    }
+    scripts = entry_points()
+    selected = set(ns.stages.split(",")) if ns.stages else None
+
+    upstream = subprocess.Popen(
+        [sys.executable, str(ROOT / "benchmarks/fake_upstream.py"), "--port", str(ns.port), *upstream_args]
+    )
+    results = []
+    try:
+        wait_for_port(ns.port)
+        print(f"Data directory: {data_dir}, log: {log_path}")
+        print(
+            f"{'stage':<34} {'exit':>4} {'wall s':>8} {'requests':>9} {'req/s':>8} "
+            f"{'MiB':>8} {'MiB/s':>8} {'RSS MiB':>8}"
+        )
+
+        with open(log_path, "w") as log:
+            for script, args in ORCHESTRATED if ns.orchestrated else STAGES:
+                if selected and script not in selected and script.removeprefix("dynabook-") not in selected:
+                    continue
+                before = upstream_stats(ns.port)
+                code, wall, rss = run_stage(script, scripts[script], args, env, log)
+                after = upstream_stats(ns.port)
+
+                requests = after["requests"] - before["requests"]
+                mib = (after["bytes"] - before["bytes"]) / 1024**2
+                results.append(
+                    {
+                        "stage": script,
+                        "exit_code": code,
+                        "wall_time": wall,
+                        "requests": requests,
+                        "bytes": after["bytes"] - before["bytes"],
+                        "peak_rss": rss,
+                    }
+                )
+                print(
+                    f"{script:<34} {code:>4} {wall:>8.2f} {requests:>9} {requests / wall:>8.1f} "
+                    f"{mib:>8.1f} {mib / wall:>8.1f} {rss / 1024**2:>8.1f}"
+                )
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+    if ns.json:
+        with open(ns.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
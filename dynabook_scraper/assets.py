@@ -4,11 +4,15 @@ import aiofiles
 import aiohttp
 from tqdm import tqdm
 
-from dynabook_scraper.utils.common import run_concurrently, download_file
+from dynabook_scraper.utils.download import download_file
 from .utils import json
+from .utils.pool import WorkerPool
 from .utils.paths import assets_dir, products_work_dir, data_dir
 from .utils.uvloop import async_run
 
+# Upper bound on workers, actual parallelism is adjusted per host by utils.throttle
+CONCURRENCY = 50
+
 
 async def download_asset(path: str):
     path = path.lstrip("/")
@@ -49,7 +53,7 @@ async def scrape_assets():
         await download_asset(path)
         progress.update()
 
-    await run_concurrently(30, coro, assets)
+    await WorkerPool(CONCURRENCY, coro, return_exceptions=True).run(assets)
 
 
 def cli_scrape_assets():
@@ -1,15 +1,12 @@
 import abc
 import asyncio
-import os
 import re
 import time
 import warnings
-from collections import defaultdict
 from pathlib import Path
 from typing import Any, Type
 from urllib.parse import urlparse
 
-import aiofiles
 import aiohttp
 import bs4
 import internetarchive
@@ -17,13 +14,18 @@ from asgiref.sync import sync_to_async
 from duckduckgo_search import DDGS
 from tqdm import tqdm
 
-from dynabook_scraper.utils import json
-from dynabook_scraper.utils.common import download_file, write_result_file, run_concurrently, http_retry
-from dynabook_scraper.utils.paths import content_dir, downloads_dir, data_dir
+from dynabook_scraper.utils import http, http_cache, rescue_cache, state
+from dynabook_scraper.utils.common import write_result_file, http_retry
+from dynabook_scraper.utils.download import download_file
+from dynabook_scraper.utils.pool import WorkerPool
+from dynabook_scraper.utils.paths import downloads_dir
 from dynabook_scraper.utils.uvloop import async_run
 
 REALLY_DO_SEARCH = False
 
+# Upper bound on workers, actual parallelism is adjusted per host by utils.throttle
+CONCURRENCY = 20
+
 rescuers = []
 
 
@@ -43,10 +45,6 @@ class NotFoundError(Exception):
         self.mirror_url = mirror_url
 
 
-potential_results: dict[str, dict[str, str]] = defaultdict(dict)
-search_cache: dict[str, list[dict[str, str]]] = {}
-memento_cache: dict[str, str] = {}
-
 ddgs = DDGS()
 
 TIME_BETWEEN_SEARCHES = 10  # seconds
@@ -57,8 +55,9 @@ _search_lock = asyncio.Lock()
 @http_retry
 async def ddg_search(query):
     search_fn = sync_to_async(ddgs.text, thread_sensitive=False)
-    if query in search_cache:
-        return search_cache[query]
+    results = rescue_cache.get_search(query)
+    if results is not None:
+        return results
 
     if not REALLY_DO_SEARCH:
         return []
@@ -71,7 +70,7 @@ async def ddg_search(query):
         _last_search_time = time.time()
 
         results = await search_fn(query)
-        search_cache[query] = results
+        rescue_cache.put_search(query, results)
         return results
 
 
@@ -79,37 +78,32 @@ async def ddg_search(query):
 class MementoRescuer(FileRescuerStrategy):
     @http_retry
     async def download(self, url: str, out_dir: Path, details: dict[str, Any]) -> dict[str, Any]:
-        async with aiohttp.ClientSession() as session:
-            if url in memento_cache:
-                if not memento_cache[url]:
-                    raise NotFoundError(url, "https://timetravel.mementoweb.org")
-                archive_url = memento_cache[url]
-            else:
-                async with session.get(
-                    f"https://timetravel.mementoweb.org/timegate/{url}", allow_redirects=False
-                ) as response:
-                    response.raise_for_status()
-                    if response.status != 302:
-                        memento_cache[url] = ""
-                        tqdm.write(f"Content not available on timetravel.mementoweb.org: {url}")
-                        raise aiohttp.ClientResponseError(
-                            response.request_info, response.history, status=response.status
-                        )
-                archive_url = response.headers["Location"]
-                memento_cache[url] = archive_url
+        archive_url = rescue_cache.get_memento(url)
+        if archive_url == "":
+            raise NotFoundError(url, "https://timetravel.mementoweb.org")
+        if archive_url is None:
+            async with http.get(f"https://timetravel.mementoweb.org/timegate/{url}", allow_redirects=False) as response:
+                response.raise_for_status()
+                if response.status != 302:
+                    rescue_cache.put_memento(url, "")
+                    tqdm.write(f"Content not available on timetravel.mementoweb.org: {url}")
+                    raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status)
+            archive_url = response.headers["Location"]
+            rescue_cache.put_memento(url, archive_url)
 
         hostname = urlparse(archive_url).hostname
 
         filename = Path(url).name
         tqdm.write(f"Downloading from Memento {hostname}: {url}")
-        await download_file(archive_url, out_dir, out_filename=filename)
+        info = await download_file(archive_url, out_dir, out_filename=filename)
 
         fname = Path(archive_url).name
-        potential_results[fname.lower()][str((out_dir / fname).stat().st_size)] = archive_url
+        rescue_cache.add_potential_results([(fname, (out_dir / fname).stat().st_size, archive_url)])
 
         return {
             "mirror_url": archive_url,
             "rescue_strategy": "memento",
+            **info,
         }
 
 
@@ -124,11 +118,9 @@ class DuckSearchInternetArchiveRescuer(FileRescuerStrategy):
         all_files = await sync_to_async(internetarchive.get_files, thread_sensitive=False)(ia_id)
 
         # Add the item files to the potential results
-        for file in all_files:
-            if "_MACOSX" in file.name:
-                continue
-            fname = Path(file.name).name.lower()
-            potential_results[fname][str(file.size)] = file.url
+        rescue_cache.add_potential_results(
+            (Path(file.name).name, file.size, file.url) for file in all_files if "_MACOSX" not in file.name
+        )
 
         files = [
             i
@@ -160,10 +152,7 @@ class DuckSearchInternetArchiveRescuer(FileRescuerStrategy):
     async def _get_ia_archive_content_file_url(
         url: str, filename: str, details: dict[str, Any]
     ) -> tuple[str, int] | None:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                response.raise_for_status()
-                page = await response.text()
+        page = (await http_cache.cached_get(url)).text()
 
         soup = bs4.BeautifulSoup(page, "html.parser")
         table = soup.find("table")
@@ -186,7 +175,8 @@ class DuckSearchInternetArchiveRescuer(FileRescuerStrategy):
             size = int(size_el[0].text)
 
             files.append((fname, url, size))
-            potential_results[fname][str(size)] = url
+
+        rescue_cache.add_potential_results((fname, size, url) for fname, url, size in files)
 
         file_size = details.get("fileSize")
 
@@ -205,16 +195,16 @@ class DuckSearchInternetArchiveRescuer(FileRescuerStrategy):
         found_file_url = None
         strategy = None
         size = 0
-        if filename.lower() in potential_results:
+        files = rescue_cache.find_potential_results(filename.lower())
+        if files:
             if "fileSize" in details:
                 file_size = details["fileSize"]
-                files = potential_results[filename.lower()]
                 if str(file_size) in files:
                     found_file_url = files[str(file_size)]
                     size = file_size
                     strategy = "potential_results"
             else:
-                found_file_url = next(iter(potential_results[filename.lower()].values()))
+                found_file_url = next(iter(files.values()))
                 strategy = "potential_results"
 
         if not found_file_url:
@@ -251,37 +241,18 @@ class DuckSearchInternetArchiveRescuer(FileRescuerStrategy):
             found_file_url = f"https:{found_file_url}"
 
         tqdm.write(f"Downloading from Internet Archive: {url}")
-        await download_file(found_file_url, out_dir, size=size, out_filename=filename)
+        info = await download_file(found_file_url, out_dir, size=size, out_filename=filename)
 
         return {
             "mirror_url": found_file_url,
             "rescue_strategy": strategy,
+            **info,
         }
 
 
 async def find_broken_links_content():
-    for file in tqdm(os.listdir(content_dir), desc="Discovering broken links", unit="file"):
-        if not file.endswith("_crawl_result.json"):
-            continue
-        content_id = file.replace("_crawl_result.json", "")
-
-        try:
-            async with aiofiles.open(content_dir / file) as f:
-                result = await json.aload(f)
-        except Exception as e:
-            tqdm.write(f"Error processing {file}: {e}")
-            raise
-
-        if result["status_code"] == 200:
-            continue
-
-        async with aiofiles.open(content_dir / f"{content_id}.json") as f:
-            details = await json.aload(f)
-
-        # Other content types are not implemented for now
-        if details["contentType"] not in ("DL", "UG", "scraper-static-content"):
-            continue
-
+    # Other content types are not implemented for now
+    for details in state.failed_contents(("DL", "UG", "scraper-static-content")):
         # Ignore contents with missing links
         if not details.get("contentFile"):
             continue
@@ -314,56 +285,41 @@ async def scrape_broken_link(details) -> bool:
 
 
 async def scrape_broken_links():
-    potential_results_path = data_dir / "potential_results.json"
-    if potential_results_path.is_file():
-        async with aiofiles.open(potential_results_path) as f:
-            potential_results.update(await json.aload(f))
-
-    search_cache_path = data_dir / "search_cache.json"
-    if search_cache_path.is_file():
-        async with aiofiles.open(search_cache_path) as f:
-            search_cache.update(await json.aload(f))
-
-    memento_cache_path = data_dir / "memento_cache.json"
-    if memento_cache_path.is_file():
-        async with aiofiles.open(memento_cache_path) as f:
-            memento_cache.update(await json.aload(f))
+    broken_links = []
+    async for details in find_broken_links_content():
+        broken_links.append(details)
 
-    try:
-        broken_links = []
-        async for details in find_broken_links_content():
-            broken_links.append(details)
+    progress = tqdm(total=len(broken_links), desc="Scraping broken links")
 
-        progress = tqdm(total=len(broken_links), desc="Scraping broken links")
+    rescued_count = 0
+    failed_count = 0
 
-        rescued_count = 0
-        failed_count = 0
+    async def coro(details):
+        rescued = await scrape_broken_link(details)
+        if rescued:
+            nonlocal rescued_count
+            rescued_count += 1
+        else:
+            nonlocal failed_count
+            failed_count += 1
+        progress.update()
 
-        async def coro(details):
-            rescued = await scrape_broken_link(details)
-            if rescued:
-                nonlocal rescued_count
-                rescued_count += 1
-            else:
-                nonlocal failed_count
-                failed_count += 1
-            progress.update()
+    try:
+        await WorkerPool(CONCURRENCY, coro, return_exceptions=True).run(broken_links)
+    finally:
+        tqdm.write(f"Rescued {rescued_count} links, failed to rescue {failed_count} links")
 
-        try:
-            await run_concurrently(5, coro, broken_links)
-        finally:
-            tqdm.write(f"Rescued {rescued_count} links, failed to rescue {failed_count} links")
 
-    finally:
-        with open(potential_results_path, "w") as f:
-            json.dump(potential_results, f)
+def cli_scrape_broken_links():
+    http_cache.cli_configure()
+    async_run(scrape_broken_links())
 
-        with open(search_cache_path, "w") as f:
-            json.dump(search_cache, f)
 
-        with open(memento_cache_path, "w") as f:
-            json.dump(memento_cache, f)
+def cli_export_rescue_cache():
+    counts = rescue_cache.export_json()
+    tqdm.write("Exported " + ", ".join(f"{count} entries to {name}" for name, count in counts.items()))
 
 
-def cli_scrape_broken_links():
-    async_run(scrape_broken_links())
+def cli_compact_rescue_cache():
+    before, after = rescue_cache.compact()
+    tqdm.write(f"Compacted the rescue cache from {before / 1024**2:.1f} MiB to {after / 1024**2:.1f} MiB")
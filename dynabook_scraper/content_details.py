@@ -1,22 +1,39 @@
+import asyncio
 import dataclasses
-import os
+import itertools
 import re
+import time
 from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Any, Dict, OrderedDict
+from typing import Any, Callable, Dict, Iterable, Iterator, OrderedDict
 from urllib.parse import urlencode
 
-import aiofiles
 import aiohttp
 import bs4
 from tqdm import tqdm
 
-from dynabook_scraper.utils.common import run_concurrently, remove_null_fields, http_retry
+from dynabook_scraper.utils.common import cli_option, http_retry, parse_duration, remove_null_fields
 from .fix_markup import toshiba_support_re, dynabook_support_re, fix_content_markup, static_content_re
-from .utils import json
-from .utils.paths import products_work_dir, content_dir
+from .utils import json, http_cache, state
+from .utils.json_loader import load_json_files
+from .utils.pool import WorkerPool
+from .utils.processes import get_executor
+from .utils.paths import products_work_dir
 from .utils.uvloop import async_run
 
+# Upper bound on workers, actual parallelism is adjusted per host by utils.throttle
+CONCURRENCY = 50
+
+js_link_re = re.compile(r"javascript:openSubDoc\(['\"](\d+)['\"]\s*,\s*['\"]\w+['\"]\)")
+# The support links fixed by fix_markup and the links it produces, in a single pass. Each alternative has one group.
+content_link_re = re.compile(
+    "|".join(
+        f"(?:{regex.pattern})" for regex in (toshiba_support_re, dynabook_support_re, static_content_re, js_link_re)
+    )
+)
+# Number of details handed to a parsing process at once
+LINK_SCAN_CHUNK_SIZE = 100
+
 
 @dataclass
 class Content:
@@ -27,89 +44,138 @@ class Content:
 
 
 class ContentDownloader:
-    def __init__(self):
+    def __init__(self, on_added: Callable[[Content], Any] | None = None, follow_links: bool = True):
         self.contents: Dict[str, Content] = {}
         self.downloaded_ids = set()
-
-    def ingest(self, content: dict[str, Any]):
-        cid = content["contentID"]
+        # Contents only known from a link so far, whose type is a guess
+        self.linked_ids = set()
+        # Kind of content list (see CONTENT_LISTS) each listed content was first found in
+        self.listed_kinds: dict[str, str | None] = {}
+        # Called with every content seen for the first time, including versions found while downloading
+        self.on_added = on_added
+        # Whether download_contents also fetches the contents linked from the details it fetches
+        self.follow_links = follow_links
+        # Contents waiting to be fetched while download_contents runs, None wakes it up once everything is done
+        self._queue: asyncio.Queue[Content | None] | None = None
+        self._outstanding = 0
+        # Name of the stage whose frontier download_contents persists
+        self._stage = ""
+
+    def _added(self, content: Content):
+        if self.on_added:
+            self.on_added(content)
+        if self._queue is not None:
+            state.add_to_frontier(self._stage, [(content.contentID, content.contentType, content.sor)])
+            self._enqueue(content)
+
+    def _enqueue(self, content: Content):
+        self._outstanding += 1
+        self._queue.put_nowait(content)
+
+    def _mark_done(self, content: Content, failed: bool = False):
+        state.mark_frontier_done(self._stage, content.contentID, failed)
+        self.downloaded_ids.add(content.contentID)
+        self._outstanding -= 1
+        if self._outstanding == 0:
+            self._queue.put_nowait(None)
+
+    def ingest(self, content: dict[str, Any], kind: str | None = None):
+        """Ingest a content, listed by a product in a content list of the given kind (see CONTENT_LISTS) if known."""
+        # Drivers have numeric IDs, links have string ones
+        cid = str(content["contentID"])
         ctype = content["contentType"]
         sor = content.get("sor") or "undefined"
         c = Content(cid, ctype, sor)
 
-        if cid in self.contents and self.contents[cid] != c:
+        if cid in self.linked_ids and self.contents[cid] != c:
+            # Reached through a link before the product listing it was parsed, the listing knows its actual type
+            self.linked_ids.discard(cid)
+            self.listed_kinds[cid] = kind
+            self.contents[cid] = c
+            self._added(c)
+        elif cid in self.contents and self.contents[cid] != c and self.listed_kinds.get(cid, kind) != kind:
+            # Listed as another kind of content too, e.g. as a driver and as a manual. The details are stored by ID
+            # only, so the content is fetched once, as it was first listed.
+            tqdm.write(f"Content {cid} listed as {self.contents[cid]} and as {c}, fetching it once as the former")
+        elif cid in self.contents and self.contents[cid] != c:
             print(f"Duplicate content ID with different content: {cid}")
             print(f"Previous content: {self.contents[cid]}")
             print(f"New content: {c}")
             raise ValueError(f"Duplicate content ID with different content: {cid}")
-        else:
+        elif cid not in self.contents:
+            self.listed_kinds[cid] = kind
             self.contents[cid] = c
+            self._added(c)
+
+    def ingest_link(self, cid: str):
+        """Ingest a content found in a link, unless it's already known. A later listing of it takes precedence."""
+        if cid not in self.contents:
+            self.ingest({"contentID": cid, "contentType": "DL", "sor": "undefined"})
+            self.linked_ids.add(cid)
 
     def add_version(self, base_content: Content, new_id: str):
+        new_id = str(new_id)
         new_content = dataclasses.replace(base_content, contentID=new_id, sor="undefined")
         if new_id not in self.contents:
             self.contents[new_id] = new_content
+            self._added(new_content)
 
     @http_retry
     async def _fetch_regular_content(self, content: Content) -> dict[str, Any]:
-        async with aiohttp.ClientSession() as session:
-            params = OrderedDict[str, str]()
-            params["contentType"] = content.contentType
-            params["contentId"] = content.contentID
-            params["cipherKey"] = ""
-
-            match content.contentType:
-                case "DL" | "UG":  # Download (drivers) | User guide
-                    params["sor"] = content.sor
-                case "IA" | "SB":  # Issue alert | Support bulletin
-                    params["freeText"] = content.freeText
-                case _:
-                    raise ValueError(f"Unsupported content type: {content.contentType}")
-
-            async with session.get(
-                f"https://support.dynabook.com/support/contentDetail?{urlencode(params)}",
-            ) as response:
-                response.raise_for_status()
-                resp = await response.json()
-
-                # Ingest previous versions
-                if "contentVersion" in resp and resp["contentVersion"]:
-                    for version in resp["contentVersion"]:
-                        self.add_version(content, version["contentID"])
-
-                return remove_null_fields(resp)
+        params = OrderedDict[str, str]()
+        params["contentType"] = content.contentType
+        params["contentId"] = content.contentID
+        params["cipherKey"] = ""
+
+        match content.contentType:
+            case "DL" | "UG":  # Download (drivers) | User guide
+                params["sor"] = content.sor
+            case "IA" | "SB":  # Issue alert | Support bulletin
+                params["freeText"] = content.freeText
+            case _:
+                raise ValueError(f"Unsupported content type: {content.contentType}")
+
+        response = await http_cache.cached_get(
+            f"https://support.dynabook.com/support/contentDetail?{urlencode(params)}", expect_json=True
+        )
+        resp = response.json()
+
+        # Ingest previous versions
+        if "contentVersion" in resp and resp["contentVersion"]:
+            for version in resp["contentVersion"]:
+                self.add_version(content, version["contentID"])
+
+        return remove_null_fields(resp)
 
     @staticmethod
     @http_retry
     async def _fetch_static_content(content: Content) -> dict[str, Any]:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"https://support.dynabook.com/support/staticContentDetail?contentId={content.contentID}&isFromTOCLink=false",
-            ) as response:
-                response.raise_for_status()
-                page = await response.text()
-
-            soup = bs4.BeautifulSoup(page, "html.parser")
-            iframe = soup.find("iframe")
-
-            if not iframe:
-                raise ValueError("Could not find iframe in static content")
-
-            if iframe.attrs["type"] == "application/pdf":
-                return {
-                    "contentID": content.contentID,
-                    "contentType": "scraper-static-content",
-                    "contentFile": iframe.attrs["src"],
-                }
-            elif iframe.attrs["type"] == "text/html":
-                return {
-                    "contentID": content.contentID,
-                    "contentType": "scraper-swf",
-                    "originalContentType": content.contentType,
-                    "contentFile": iframe.attrs["src"],
-                }
-            else:
-                raise ValueError(f"Unsupported iframe type: {iframe.attrs['type']}")
+        response = await http_cache.cached_get(
+            f"https://support.dynabook.com/support/staticContentDetail?contentId={content.contentID}&isFromTOCLink=false",
+        )
+        page = response.text()
+
+        soup = bs4.BeautifulSoup(page, "html.parser")
+        iframe = soup.find("iframe")
+
+        if not iframe:
+            raise ValueError("Could not find iframe in static content")
+
+        if iframe.attrs["type"] == "application/pdf":
+            return {
+                "contentID": content.contentID,
+                "contentType": "scraper-static-content",
+                "contentFile": iframe.attrs["src"],
+            }
+        elif iframe.attrs["type"] == "text/html":
+            return {
+                "contentID": content.contentID,
+                "contentType": "scraper-swf",
+                "originalContentType": content.contentType,
+                "contentFile": iframe.attrs["src"],
+            }
+        else:
+            raise ValueError(f"Unsupported iframe type: {iframe.attrs['type']}")
 
     async def _fetch_content_details(self, content: Content) -> dict[str, Any]:
         if content.contentType in (
@@ -135,128 +201,212 @@ class ContentDownloader:
         ):
             return await self._fetch_static_content(content)
 
-    async def download_content_details(self, content: Content):
+    async def download_content_details(self, content: Content) -> dict[str, Any] | None:
         try:
             details = await self._fetch_content_details(content)
         except aiohttp.client_exceptions.ContentTypeError:
             tqdm.write(f"Warning: Failed to fetch content details for {content} due to invalid content type")
-            return
+            return None
 
         details = await fix_content_markup(details)
 
-        async with aiofiles.open(content_dir / f"{content.contentID}.json", "wb") as f:
-            await json.adump(details, f)
-
-    async def download_contents(self):
-        progress = tqdm(total=len(self.contents), desc="Downloading contents")
+        state.put_details(details)
+        state.set_details_fetched(content.contentID)
+        return details
+
+    def _resume(self):
+        failed = 0
+        for cid, content_type, sor, status in state.get_frontier(self._stage):
+            if cid not in self.contents:
+                self.contents[cid] = Content(cid, content_type, sor)
+            if status == "done":
+                self.downloaded_ids.add(cid)
+            failed += status == "failed"
+        if self.downloaded_ids:
+            tqdm.write(f"Resuming an interrupted run, {len(self.downloaded_ids)} contents already done")
+        if failed:
+            tqdm.write(f"Retrying {failed} contents that failed in a previous run")
+
+    async def download_contents(self, stage: str, max_age: float | None = None):
+        """
+        Fetch the details of every content, and of the versions and linked contents they lead to.
+
+        Everything goes through a single frontier: newly found contents are queued right away rather than after the
+        current batch, and the frontier is persisted under the name of the stage so that an interrupted run of the
+        same stage picks up where it stopped. Contents that failed are retried by the next run of the stage.
+
+        With max_age (in seconds), contents whose details were fetched more recently than that are not requested
+        again; their stored details are used to find their versions and links instead.
+        """
+        fresh = state.fresh_details(time.time() - max_age) if max_age is not None else set()
+        skipped = 0
+        self._stage = stage
+        self._resume()
+        pending = [c for c in self.contents.values() if c.contentID not in self.downloaded_ids]
+        state.add_to_frontier(stage, ((c.contentID, c.contentType, c.sor) for c in pending))
+
+        self._queue = asyncio.Queue()
+        self._outstanding = 0
+        for content in pending:
+            self._enqueue(content)
+        if not pending:
+            self._queue.put_nowait(None)
+
+        progress = tqdm(total=len(self.contents), initial=len(self.downloaded_ids), desc="Downloading contents")
+
+        async def frontier():
+            while (content := await self._queue.get()) is not None:
+                yield content
 
         async def coro(content: Content):
-            await self.download_content_details(content)
-            progress.update()
-            self.downloaded_ids.add(content.contentID)
-
-            # Refresh the progress bar total in case new versions were added
-            progress.total = len(self.contents)
-            progress.refresh()
-
-        while len(self.contents) > len(self.downloaded_ids):
-            opaque_iterator = (i for i in self.contents.values() if i.contentID not in self.downloaded_ids)
-            await run_concurrently(20, coro, opaque_iterator)
-
-
-def gather_drivers(downloader: ContentDownloader):
-    driver_jsons = products_work_dir.glob("*/drivers.json")
+            nonlocal skipped
+            try:
+                if content.contentID in fresh:
+                    details = state.get_details(content.contentID)
+                    for version in details.get("contentVersion") or []:
+                        self.add_version(content, version["contentID"])
+                    skipped += 1
+                else:
+                    details = await self.download_content_details(content)
+                if details is not None and self.follow_links:
+                    raw = json.dumps(details)
+                    for cid in find_content_links(raw.decode() if isinstance(raw, bytes) else raw):
+                        self.ingest_link(cid)
+            except Exception:
+                # Failures are reported by the pool and only retried by the next run
+                self._mark_done(content, failed=True)
+                raise
+            finally:
+                # Refresh the progress bar total in case new contents were added
+                progress.total = len(self.contents)
+                progress.update()
+            self._mark_done(content)
 
-    for f in tqdm(list(driver_jsons), desc="Gathering drivers", unit="file"):
         try:
-            with open(f) as file:
-                j = json.load(file)
-
-                for _, driver in j["contents"].items():
-                    downloader.ingest(driver)
+            await WorkerPool(CONCURRENCY, coro, return_exceptions=True).run(frontier())
+        finally:
+            self._queue = None
+            progress.close()
+        state.clear_frontier(stage)
+        if max_age is not None:
+            fetched = len(self.downloaded_ids) - skipped
+            tqdm.write(f"Avoided {skipped} requests for contents fetched within the max age, {fetched} fetched")
+
+
+# Contents listed in the work directory of each product: file name and how to get the contents out of it
+CONTENT_LISTS: dict[str, tuple[str, Callable[[Any], Iterable[dict[str, Any]]]]] = {
+    "drivers": ("drivers.json", lambda j: j["contents"].values()),
+    "knowledge base": ("knowledge_base.json", lambda j: j),
+    "manuals and specs": ("manuals_and_specs.json", lambda j: j),
+}
+
+
+def gather_contents(downloader: ContentDownloader, kinds: Iterable[str] = tuple(CONTENT_LISTS)):
+    """Ingest the contents of the given kinds listed by every product, reading the files in parallel."""
+    kinds = list(kinds)
+    extractors = {CONTENT_LISTS[kind][0]: CONTENT_LISTS[kind][1] for kind in kinds}
+    kinds_by_file = {CONTENT_LISTS[kind][0]: kind for kind in kinds}
+    paths = [path for name in extractors for path in products_work_dir.glob(f"*/{name}")]
+
+    desc = f"Gathering {kinds[0]}" if len(kinds) == 1 else "Gathering contents"
+    for path, j in tqdm(load_json_files(paths), total=len(paths), desc=desc, unit="file"):
+        try:
+            for content in extractors[path.name](j):
+                downloader.ingest(content, kinds_by_file[path.name])
         except Exception as e:
-            print(f"Error processing {f}: {e}")
+            print(f"Error processing {path}: {e}")
             raise
 
 
-def gather_knowledge_base(downloader: ContentDownloader):
-    kb_jsons = products_work_dir.glob("*/knowledge_base.json")
+def gather_drivers(downloader: ContentDownloader):
+    gather_contents(downloader, ["drivers"])
 
-    for f in tqdm(list(kb_jsons), desc="Gathering knowledge base", unit="file"):
-        try:
-            with open(f) as file:
-                j = json.load(file)
 
-                for kb in j:
-                    downloader.ingest(kb)
-        except Exception as e:
-            print(f"Error processing {f}: {e}")
-            raise
+def gather_knowledge_base(downloader: ContentDownloader):
+    gather_contents(downloader, ["knowledge base"])
 
 
 def gather_manuals_and_specs(downloader: ContentDownloader):
-    manuals_jsons = products_work_dir.glob("*/manuals_and_specs.json")
+    gather_contents(downloader, ["manuals and specs"])
 
-    for f in tqdm(list(manuals_jsons), desc="Gathering manuals and specs", unit="file"):
-        try:
-            with open(f) as file:
-                j = json.load(file)
 
-                for manual in j:
-                    downloader.ingest(manual)
-        except Exception as e:
-            print(f"Error processing {f}: {e}")
-            raise
+def find_content_links(raw: str) -> set[str]:
+    """IDs of the contents linked from serialized content details."""
+    return {match.group(match.lastindex) for match in content_link_re.finditer(raw)}
+
+
+def scan_content_links(raws: list[str]) -> list[set[str]]:
+    return [find_content_links(raw) for raw in raws]
 
 
 def gather_content_links(downloader: ContentDownloader):
-    files = [i for i in os.listdir(content_dir) if i.endswith(".json") and not i.endswith("_crawl_result.json")]
-
-    js_link_re = re.compile(r"javascript:openSubDoc\(['\"](\d+)['\"]\s*,\s*['\"]\w+['\"]\)")
-
-    for file in tqdm(files, desc="Finding content links", unit="file"):
-        with open(content_dir / file) as f:
-            raw = f.read()
-
-            matches = [
-                toshiba_support_re.findall(raw),
-                dynabook_support_re.findall(raw),
-                static_content_re.findall(raw),
-                js_link_re.findall(raw),
-            ]
-
-            for match_group in matches:
-                if not match_group:
-                    continue
-                for match in match_group:
-                    downloader.ingest(
-                        {
-                            "contentID": match,
-                            "contentType": "DL",
-                            "sor": "undefined",
-                        }
-                    )
+    """
+    Ingest every content linked from the stored details.
+
+    The links of each content are kept in the state database, so only the details that changed since the previous run
+    are scanned, in the parsing process pool.
+    """
+    executor = get_executor()
+    progress = tqdm(total=state.count_unscanned_links(), desc="Finding content links", unit="content")
+
+    def save(page: list[tuple[str, str, float]], results: Iterator[list[set[str]]]):
+        links = itertools.chain.from_iterable(results)
+        state.put_content_links((cid, updated_at, cids) for (cid, _, updated_at), cids in zip(page, links))
+        progress.update(len(page))
+
+    # Save each page while the next one is being read and scanned
+    previous = None
+    for page in state.iter_unscanned_links():
+        raws = [raw for _, raw, _ in page]
+        chunks = [raws[i : i + LINK_SCAN_CHUNK_SIZE] for i in range(0, len(raws), LINK_SCAN_CHUNK_SIZE)]
+        results = executor.map(scan_content_links, chunks)
+        if previous:
+            save(*previous)
+        previous = page, results
+    if previous:
+        save(*previous)
+    progress.close()
+
+    for match in state.all_content_links():
+        downloader.ingest_link(match)
+
+
+def _max_age() -> float | None:
+    http_cache.cli_configure()
+    value = cli_option("--max-age")
+    if not value:
+        return None
+    # Stale details must come from the network, not from an older cached response
+    max_age = parse_duration(value)
+    http_cache.configure(max_age=max_age)
+    return max_age
 
 
 def cli_scrape_driver_contents():
     downloader = ContentDownloader()
     gather_drivers(downloader)
-    async_run(downloader.download_contents())
+    async_run(downloader.download_contents("drivers", max_age=_max_age()))
 
 
 def cli_scrape_kb_contents():
     downloader = ContentDownloader()
     gather_knowledge_base(downloader)
-    async_run(downloader.download_contents())
+    async_run(downloader.download_contents("kb", max_age=_max_age()))
 
 
 def cli_scrape_manuals_contents():
     downloader = ContentDownloader()
     gather_manuals_and_specs(downloader)
-    async_run(downloader.download_contents())
+    async_run(downloader.download_contents("manuals", max_age=_max_age()))
+
+
+def cli_scrape_all_contents():
+    downloader = ContentDownloader()
+    gather_contents(downloader)
+    async_run(downloader.download_contents("all", max_age=_max_age()))
 
 
 def cli_scrape_content_links():
     downloader = ContentDownloader()
     gather_content_links(downloader)
-    async_run(downloader.download_contents())
+    async_run(downloader.download_contents("links", max_age=_max_age()))
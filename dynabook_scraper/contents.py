@@ -1,32 +1,76 @@
-import os
-import shutil
+import asyncio
 import sys
 import traceback
 from pathlib import Path
-from typing import Any
+from typing import Any, AsyncIterator
+from urllib.parse import urlparse
 
 import aiofiles
+import aiofiles.os
 import aiohttp
 import bs4
 from tqdm import tqdm
 
-from dynabook_scraper.utils.common import run_concurrently, download_file, write_result_file
-from .utils import json
-from .utils.paths import content_dir, downloads_dir
+from dynabook_scraper.utils.common import write_result_file, cli_flag
+from dynabook_scraper.utils.download import download_file, fetch_validators
+from dynabook_scraper.utils.scheduler import SizeAwareScheduler
+from .utils import state
+from .utils.paths import downloads_dir
 from .utils.uvloop import async_run
 
-CONCURRENCY = 10
+# Upper bound on workers, actual parallelism is adjusted per host by utils.throttle
+CONCURRENCY = 50
+# Number of discovered contents waiting for a worker before discovery pauses
+DISCOVERY_QUEUE_SIZE = 1000
+# Keys of a crawl result that describe the downloaded file, as returned by download_file
+VALIDATOR_KEYS = ("etag", "last_modified", "content_length", "sha256")
 
 
 def handle_error(cid: str, details: dict[str, Any], out_dir: Path):
-    shutil.rmtree(out_dir)
+    # Keep partial downloads, and the segment progress of segmented ones, around so that the next run can resume them
+    if out_dir.is_dir():
+        for path in sorted(out_dir.rglob("*"), reverse=True):
+            if path.is_dir() and not path.is_symlink():
+                if not any(path.iterdir()):
+                    path.rmdir()
+            elif not path.name.endswith((".part", ".part.segments")):
+                path.unlink()
     traceback.print_exc()
     with open("errors.txt", "a") as f:
         print(f"Error downloading content [{cid}] {details.get('contentFile')}", file=f)
         traceback.print_exc(file=f)
 
 
-async def download_content(details: dict[str, Any]):
+async def local_size(path: Path) -> int | None:
+    """Size of a downloaded file, or None if it doesn't exist. A single stat, run off the event loop."""
+    try:
+        return (await aiofiles.os.stat(path)).st_size
+    except FileNotFoundError:
+        return None
+
+
+def stored_validators(result: dict[str, Any] | None) -> dict[str, Any]:
+    """The validators recorded in a previous crawl result, without its other fields."""
+    return {k: result[k] for k in VALIDATOR_KEYS if k in result} if result else {}
+
+
+def is_up_to_date(details: dict[str, Any], result: dict[str, Any] | None, size: int | None) -> bool:
+    """Check whether a previously downloaded file of the given local size can be kept without asking the server."""
+    if size is None:
+        return False
+    if "fileSize" in details:
+        return details["fileSize"] == size
+    return bool(result) and result.get("status_code") == 200 and result.get("actual_size") == size
+
+
+async def download_content(details: dict[str, Any], refresh: bool = False):
+    """
+    Download the file(s) of a content item.
+
+    Files that are already present are skipped. In refresh mode they are revalidated instead: with a conditional
+    request if the previous crawl result has an ETag or Last-Modified, otherwise with a HEAD request comparing the
+    Content-Length with the local file.
+    """
     cid = details["contentID"]
     content_type = details["contentType"]
     out_dir = downloads_dir / str(cid)
@@ -34,6 +78,8 @@ async def download_content(details: dict[str, Any]):
     filename = None
 
     try:
+        result = state.get_result(cid)
+
         if content_type in ("DL", "UG", "scraper-static-content"):
             url = details.get("contentFile")
             if not url:
@@ -41,20 +87,38 @@ async def download_content(details: dict[str, Any]):
                 return
 
             filename = Path(url).name
-            if (out_dir / filename).is_file() and (
-                "fileSize" not in details or details["fileSize"] == (out_dir / filename).stat().st_size
-            ):
-                return
-
-            await download_file(url, out_dir)
-            await write_result_file(cid, url, 200, filename, url)
+            validators = None
+            size = await local_size(out_dir / filename)
+            if is_up_to_date(details, result, size):
+                if not refresh:
+                    return
+                validators = stored_validators(result)
+                if "etag" not in validators and "last_modified" not in validators:
+                    remote = await fetch_validators(url)
+                    if remote.get("content_length") == size:
+                        await write_result_file(cid, url, 200, filename, url, **(validators | remote))
+                        return
+
+            info = await download_file(url, out_dir, size=details.get("fileSize", 0), validators=validators)
+            await write_result_file(cid, url, 200, filename, url, **info)
 
         elif content_type == "scraper-swf":
             filename = "index.html"
             url = details.get("contentFile")
             assert url, f"Content file not found: [{cid}] {details.get('contentFile')}"
             url_base = url.rsplit("/", 1)[0]
-            await download_file(url, out_dir, out_filename="index.html")
+
+            validators = None
+            if is_up_to_date(details, result, await local_size(out_dir / filename)):
+                if not refresh:
+                    return
+                validators = stored_validators(result)
+
+            info = await download_file(url, out_dir, out_filename="index.html", validators=validators)
+            if validators and info.get("sha256") == validators.get("sha256"):
+                # The page did not change, so neither did the files it references
+                await write_result_file(cid, url, 200, filename, url, **info)
+                return
 
             # Read as bytes since it looks like some files are not UTF-8 encoded
             async with aiofiles.open(out_dir / "index.html", "rb") as f:
@@ -91,7 +155,7 @@ async def download_content(details: dict[str, Any]):
             if embed:
                 await download_file(url_base + "/" + embed["src"], out_dir)
 
-            await write_result_file(cid, url, 200, filename, url)
+            await write_result_file(cid, url, 200, filename, url, **info)
     except aiohttp.ClientResponseError as e:
         await write_result_file(cid, url, e.status, filename, e.request_info.url.host)
         if e.status == 404:
@@ -100,46 +164,55 @@ async def download_content(details: dict[str, Any]):
             handle_error(cid, details, out_dir)
     except Exception:
         handle_error(cid, details, out_dir)
-        os.remove(content_dir / f"{cid}_crawl_result.json")
-
-
-async def download_contents():
-    details = []
-    for file in tqdm(os.listdir(content_dir), desc="Discovering content to download", unit="file"):
-        if not file.endswith(".json") or file.endswith("_crawl_result.json"):
-            continue
-        if (content_dir / f"{file}_crawl_result.json").is_file():
-            continue
-        async with aiofiles.open(content_dir / file) as f:
-            j = await json.aload(f)
-            if "contentID" not in j:
+        state.delete_result(cid)
+
+
+async def discover_contents(refresh: bool = False) -> AsyncIterator[dict[str, Any]]:
+    """Yield the details of the contents that need to be downloaded (or revalidated, in refresh mode)."""
+    skipped = 0
+    contents = tqdm(
+        state.iter_contents(), total=state.count_contents(), desc="Discovering content to download", unit="content"
+    )
+    for j, result in contents:
+        url = j.get("contentFile")
+        if not refresh and url:
+            filename = "index.html" if j["contentType"] == "scraper-swf" else Path(url).name
+            if is_up_to_date(j, result, await local_size(downloads_dir / str(j["contentID"]) / filename)):
+                skipped += 1
                 continue
-            details.append(j)
+        yield j
 
-    def sort_key(detail: dict[str, Any]):
-        content_id = detail["contentID"]
-        has_result = (content_dir / f"{content_id}_crawl_result.json").is_file()
-        return has_result, content_id
+    tqdm.write(f"{skipped} contents are already up to date")
 
-    details.sort(key=sort_key)
 
-    progress = tqdm(total=len(details), desc="Downloading contents")
+async def download_contents(refresh: bool = False):
+    # Downloads start as soon as the first content is discovered
+    scheduler = SizeAwareScheduler(CONCURRENCY, desc="Downloading contents", max_pending=DISCOVERY_QUEUE_SIZE)
 
-    async def coro(detail: dict[str, Any]):
-        await download_content(detail)
-        progress.update()
+    async def produce():
+        try:
+            async for j in discover_contents(refresh):
+                url = j.get("contentFile")
+                await scheduler.submit(j, j.get("fileSize"), urlparse(url).hostname if url else "")
+        finally:
+            await scheduler.close()
 
-    await run_concurrently(CONCURRENCY, coro, details)
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(produce())
+        tg.create_task(scheduler.run(lambda detail: download_content(detail, refresh)))
 
 
 def cli_download_contents():
-    async_run(download_contents())
+    async_run(download_contents(refresh=cli_flag("--refresh")))
 
 
 def cli_download_content():
+    refresh = cli_flag("--refresh")
     content_id = sys.argv[1]
 
-    with open(content_dir / f"{content_id}.json") as f:
-        details = json.load(f)
+    details = state.get_details(content_id)
+    if details is None:
+        print(f"Unknown content: {content_id}")
+        sys.exit(1)
 
-    async_run(download_content(details))
+    async_run(download_content(details, refresh))
@@ -0,0 +1,14 @@
+from tqdm import tqdm
+
+from .utils import state
+from .utils.common import cli_flag
+
+
+def cli_export_state():
+    details, results = state.export_json(full=cli_flag("--full"))
+    tqdm.write(f"Exported {details} content details and {results} crawl results")
+
+
+def cli_import_state():
+    details, results = state.import_json()
+    tqdm.write(f"Imported {details} content details and {results} crawl results")
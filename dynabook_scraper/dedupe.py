@@ -0,0 +1,45 @@
+import asyncio
+from pathlib import Path
+
+from tqdm import tqdm
+
+from dynabook_scraper.utils import blobstore
+from .utils.pool import WorkerPool
+from .utils.paths import downloads_dir
+from .utils.uvloop import async_run
+
+CONCURRENCY = 8
+
+
+async def dedupe_file(path: Path) -> int:
+    """Move a downloaded file into the blob store and replace it with a link. Returns the number of bytes saved."""
+    stat = path.stat()
+    # Already linked to a blob
+    if stat.st_nlink > 1:
+        return 0
+
+    digest = (await asyncio.to_thread(blobstore.hash_file, path)).hexdigest()
+    existed = blobstore.blob_path(digest).is_file()
+    blobstore.store(path, digest, name=path.name)
+    blobstore.link(digest, path)
+    return stat.st_size if existed else 0
+
+
+async def dedupe_downloads():
+    files = [
+        p for p in downloads_dir.rglob("*") if p.is_file() and not p.name.endswith((".part", ".part.segments", ".link"))
+    ]
+    progress = tqdm(total=len(files), desc="Deduplicating downloads", unit="file")
+    saved = 0
+
+    async def coro(path: Path):
+        nonlocal saved
+        saved += await dedupe_file(path)
+        progress.update()
+
+    await WorkerPool(CONCURRENCY, coro).run(files)
+    tqdm.write(f"Saved {saved / 1024**3:.2f} GiB")
+
+
+def cli_dedupe_downloads():
+    async_run(dedupe_downloads())
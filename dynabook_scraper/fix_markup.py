@@ -1,3 +1,5 @@
+import asyncio
+import hashlib
 import re
 import warnings
 from pathlib import Path
@@ -6,8 +8,9 @@ from typing import Any
 import bs4
 from tqdm import tqdm
 
-from dynabook_scraper.utils.common import download_file
-from dynabook_scraper.utils.paths import downloads_dir
+from dynabook_scraper.utils import blobstore
+from dynabook_scraper.utils.download import download_file
+from dynabook_scraper.utils.paths import downloads_dir, work_dir
 
 toshiba_support_re = re.compile(
     r"(?:https?:)?(?://)?www\.support\.toshiba\.com/sscontent\?contentId=(\d+)",
@@ -20,6 +23,45 @@ static_content_re = re.compile(
 )
 
 
+# Blob digest of every image fetched by this process, by URL. The same banners and icons are referenced by thousands of
+# contents, each URL is only requested once and then linked from the blob store. Failures aren't remembered: the
+# contents waiting for a fetch share its failure, the next ones try again.
+_images: dict[str, str] = {}
+_image_fetches: dict[str, asyncio.Task[str]] = {}
+images_work_dir = work_dir / "images"
+
+
+async def _fetch_image(url: str) -> str:
+    # Downloaded to a scratch name, every content then links to the blob
+    scratch_name = hashlib.sha256(url.encode()).hexdigest()
+    try:
+        info = await download_file(url, images_work_dir, out_filename=scratch_name)
+        _images[url] = info["sha256"]
+        (images_work_dir / scratch_name).unlink(missing_ok=True)
+    finally:
+        del _image_fetches[url]
+    return _images[url]
+
+
+async def fetch_image(url: str, dest: Path) -> bool:
+    """Make dest a link to the image at url, fetching it at most once per process. Returns whether it worked."""
+    if dest.is_file():
+        return True
+
+    if url not in _images:
+        if url not in _image_fetches:
+            _image_fetches[url] = asyncio.create_task(_fetch_image(url))
+        try:
+            # Shielded so that a cancelled content doesn't cancel the fetch for everyone else
+            await asyncio.shield(_image_fetches[url])
+        except Exception as e:
+            warnings.warn(f"Failed to download {url}: {e}")
+            return False
+
+    blobstore.link(_images[url], dest)
+    return True
+
+
 async def fix_markup(content_id: str, markup: str) -> str:
     soup = bs4.BeautifulSoup(markup, "html.parser")
 
@@ -37,6 +79,7 @@ async def fix_markup(content_id: str, markup: str) -> str:
             a["href"] = a["href"].replace("support.toshiba.com", "support.dynabook.com")
 
     # Fix images
+    images = []
     for img in soup.find_all("img", src=True):
         src = img["src"]
 
@@ -65,16 +108,19 @@ async def fix_markup(content_id: str, markup: str) -> str:
                 warnings.warn(f"Unpatched image link: {src}")
                 continue
 
-        fname = Path(src).name
-        dest_dir = downloads_dir / str(content_id)
-        dest_dir.mkdir(exist_ok=True, parents=True)
+        images.append((img, src, Path(src).name))
 
-        try:
-            await download_file(src, dest_dir, out_filename=fname, skip_existing=True)
-        except Exception as e:
-            warnings.warn(f"Failed to download {src}: {e}")
-            continue
-        img["src"] = f"../assets/content/{content_id}/{fname}"
+    dest_dir = downloads_dir / str(content_id)
+    # Distinct images with the same file name would share a path, the first one wins
+    targets = {}
+    for _, src, fname in images:
+        targets.setdefault(fname, src)
+
+    results = await asyncio.gather(*(fetch_image(src, dest_dir / fname) for fname, src in targets.items()))
+    fetched = {fname for fname, ok in zip(targets, results) if ok}
+    for img, src, fname in images:
+        if fname in fetched and targets[fname] == src:
+            img["src"] = f"../assets/content/{content_id}/{fname}"
 
     return str(soup)
 
@@ -88,11 +134,12 @@ async def fix_content_markup(content: dict[str, Any]) -> dict[str, Any]:
     if "markup_fixed" in content:
         return content
 
-    if "packageInstruction" in content:
-        content["packageInstruction"] = await fix_markup(cid, content["packageInstruction"])
-    for section in content.get("contentDetail", []):
-        if "content" in section:
-            section["content"] = await fix_markup(cid, section["content"])
+    async def fix_section(section: dict[str, Any], key: str):
+        section[key] = await fix_markup(cid, section[key])
+
+    sections = [(content, "packageInstruction")] if "packageInstruction" in content else []
+    sections += [(section, "content") for section in content.get("contentDetail", []) if "content" in section]
+    await asyncio.gather(*(fix_section(section, key) for section, key in sections))
 
     content["markup_fixed"] = True
     return content
@@ -19,14 +19,11 @@ def render(name: str, **kwargs) -> str:
     return template.render(**kwargs)
 
 
-def cli_build_frontend():
-    base_url = "/"
-    if len(sys.argv) > 1:
-        base_url = sys.argv[1]
-
+def build_frontend(base_url: str = "/"):
     env.globals["base_url"] = base_url.rstrip("/")
 
     svc_worker = Path(__file__).parent / "templates/dlServiceWorker.js"
+    (data_dir / "product").mkdir(exist_ok=True)
     shutil.copy2(svc_worker, data_dir / "product/dlServiceWorker.js")
 
     svc_worker_hash = hashlib.sha256(svc_worker.read_bytes()).hexdigest()
@@ -34,7 +31,6 @@ def cli_build_frontend():
     with open(data_dir / "index.html", "w") as f:
         f.write(render("home.html"))
 
-    (data_dir / "product").mkdir(exist_ok=True)
     with open(data_dir / "product" / "index.html", "w") as f:
         f.write(render("product.html", svc_worker_hash=svc_worker_hash))
 
@@ -47,5 +43,13 @@ def cli_build_frontend():
         f.write(render("eula.html"))
 
 
+def cli_build_frontend():
+    base_url = "/"
+    if len(sys.argv) > 1:
+        base_url = sys.argv[1]
+
+    build_frontend(base_url)
+
+
 if __name__ == "__main__":
     cli_build_frontend()
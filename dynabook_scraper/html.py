@@ -1,35 +1,30 @@
+import argparse
 from pathlib import Path
 
 import aiofiles
-import aiohttp
 from tqdm import tqdm
 
 from dynabook_scraper.utils.common import (
     extract_json_var,
-    run_concurrently,
     http_retry,
 )
-from .utils import json
+from .utils import html_pack, json, http_cache
+from .utils.pool import WorkerPool
 from .utils.paths import data_dir, html_dir, products_work_dir
 from .utils.uvloop import async_run
 
-CONCURRENCY = 20
+# Upper bound on workers, actual parallelism is adjusted per host by utils.throttle
+CONCURRENCY = 50
 
 
 @http_retry
-async def scrape_product_html(session: aiohttp.ClientSession, mid: str):
+async def scrape_product_html(mid: str):
     product_dir = products_work_dir / mid
     product_dir.mkdir(exist_ok=True)
     base_url = f"https://support.dynabook.com/support/modelHome?freeText={mid}"
-    async with session.get(base_url) as response:
-        response.raise_for_status()
-        page = await response.text()
+    page = (await http_cache.cached_get(base_url)).text()
 
-    product_html_dir = html_dir / str(mid)
-    product_html_dir.mkdir(exist_ok=True)
-
-    async with aiofiles.open(product_html_dir / "base.html", "w") as f:
-        await f.write(page)
+    await html_pack.write_page(mid, "base.html", page.encode())
 
     os_list = [i for i in extract_json_var(page, "partNumOSJSONArr") if i["osId"] != "-1"]
     async with aiofiles.open(product_dir / "operating_systems.json", "wb") as f:
@@ -39,14 +34,10 @@ async def scrape_product_html(session: aiohttp.ClientSession, mid: str):
     if os_list:
         os_id = os_list[0]["osId"]
 
-        async with session.get(
-            f"https://support.dynabook.com/support/modelHome?freeText={mid}&osId={os_id}"
-        ) as response:
-            response.raise_for_status()
-            os_page = await response.text()
+        os_url = f"https://support.dynabook.com/support/modelHome?freeText={mid}&osId={os_id}"
+        os_page = (await http_cache.cached_get(os_url)).text()
 
-        async with aiofiles.open(product_html_dir / f"os_{os_id}.html", "w") as f:
-            await f.write(os_page)
+        await html_pack.write_page(mid, f"os_{os_id}.html", os_page.encode())
 
 
 async def scrape_products_html(products_list: Path = data_dir / "all_products_flat.json"):
@@ -55,8 +46,7 @@ async def scrape_products_html(products_list: Path = data_dir / "all_products_fl
 
     filtered_products = {}
     for mid in all_products.keys():
-        drivers = products_work_dir / mid / "html/base.html"
-        if drivers.is_file() and drivers.stat().st_size > 0:
+        if html_pack.has_page(mid, "base.html"):
             continue
 
         filtered_products[mid] = all_products[mid]
@@ -65,14 +55,47 @@ async def scrape_products_html(products_list: Path = data_dir / "all_products_fl
 
     # noinspection PyShadowingNames
     async def coro(mid):
-        async with aiohttp.ClientSession() as session:
-            name = all_products[mid]["mname"]
-            progress.write(f"-> Model: {name} ({mid})")
-            await scrape_product_html(session, mid)
-            progress.update()
+        name = all_products[mid]["mname"]
+        progress.write(f"-> Model: {name} ({mid})")
+        await scrape_product_html(mid)
+        progress.update()
 
-    await run_concurrently(CONCURRENCY, coro, filtered_products.keys())
+    await WorkerPool(CONCURRENCY, coro, return_exceptions=True).run(filtered_products.keys())
 
 
 def cli_scrape_products_html():
+    http_cache.cli_configure()
     async_run(scrape_products_html())
+
+
+def cli_unpack_html():
+    parser = argparse.ArgumentParser(description="Extract the scraped pages of a model from the HTML packs")
+    parser.add_argument("mid")
+    parser.add_argument("dest", nargs="?", type=Path, default=Path("."), help="the pages go to DEST/<mid>/")
+    args = parser.parse_args()
+
+    async def unpack():
+        dest = args.dest / args.mid
+        dest.mkdir(parents=True, exist_ok=True)
+        for name in html_pack.page_names(args.mid):
+            async with aiofiles.open(dest / name, "wb") as f:
+                await f.write(await html_pack.read_page(args.mid, name))
+            tqdm.write(str(dest / name))
+
+    async_run(unpack())
+
+
+def cli_pack_html():
+    """Move the pages scraped before packs existed into packs."""
+
+    async def pack():
+        for product_html_dir in tqdm(sorted(html_dir.iterdir()), desc="Packing product HTMLs"):
+            if not product_html_dir.is_dir():
+                continue
+            for path in product_html_dir.glob("*.html"):
+                async with aiofiles.open(path, "rb") as f:
+                    await html_pack.write_page(product_html_dir.name, path.name, await f.read())
+                path.unlink()
+            product_html_dir.rmdir()
+
+    async_run(pack())
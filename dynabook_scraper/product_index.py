@@ -1,14 +1,25 @@
-from typing import Any
+import asyncio
+import hashlib
+import os
+import time
+import tracemalloc
+from typing import Any, Callable
 
 import aiofiles
 from cache import AsyncLRU
 from tqdm import tqdm
 
-from dynabook_scraper.utils.common import remove_null_fields, run_concurrently
-from .utils import json
-from .utils.paths import data_dir, product_dir, products_work_dir, content_dir
+from dynabook_scraper.utils.common import remove_null_fields, cli_flag
+from .utils import blobstore, json, state
+from .utils.pool import WorkerPool
+from .utils.paths import data_dir, product_dir, products_work_dir
 from .utils.uvloop import async_run
 
+# Above this number of products to regenerate, all contents are loaded in memory at once
+PRELOAD_MIN_PRODUCTS = 200
+# Report the memory used by the preloaded contents, tracing allocations slows the preloading down a lot
+TRACE_MEMORY = os.environ.get("TRACE_MEMORY") == "1"
+
 
 def filter_content(content: dict[str, Any]) -> dict[str, Any]:
     keep_keys = {
@@ -35,21 +46,128 @@ def filter_content(content: dict[str, Any]) -> dict[str, Any]:
     return {k: v for k, v in content.items() if k in keep_keys}
 
 
-@AsyncLRU(maxsize=8192)
+class ContentTable:
+    """
+    Filtered details and crawl results of every content, loaded in a single pass over the state database.
+
+    Contents only come in a handful of shapes, so each one is stored as a tuple of values sharing a tuple of keys with
+    the others, which takes a fraction of the memory of a dict per content.
+    """
+
+    def __init__(self):
+        self.rows: dict[str, tuple[tuple[str, ...], tuple]] = {}
+        self._shapes: dict[tuple[str, ...], tuple[str, ...]] = {}
+
+    @classmethod
+    def load(cls) -> "ContentTable":
+        table = cls()
+        for details, result in tqdm(state.iter_contents(), total=state.count_contents(), desc="Loading contents"):
+            cid = str(details["contentID"])
+            if result:
+                details.update(result)
+            info = filter_content(details)
+            keys = tuple(info)
+            table.rows[cid] = (table._shapes.setdefault(keys, keys), tuple(info.values()))
+        return table
+
+    def get(self, cid: str) -> dict[str, Any] | None:
+        row = self.rows.get(cid)
+        return dict(zip(*row)) if row else None
+
+
+_content_table: ContentTable | None = None
+
+
+def preload_contents():
+    """Load every content into memory, so that get_content_info never hits the database."""
+    global _content_table
+    if TRACE_MEMORY:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        _content_table = ContentTable.load()
+        elapsed = time.perf_counter() - start
+        memory = f", using {tracemalloc.get_traced_memory()[0] / 1024**2:.1f} MiB" if TRACE_MEMORY else ""
+    finally:
+        if TRACE_MEMORY:
+            tracemalloc.stop()
+    tqdm.write(f"Preloaded {len(_content_table.rows)} contents in {elapsed:.2f}s{memory}")
+
+
 async def get_content_info(cid: str) -> dict[str, Any] | None:
-    if not (content_dir / f"{cid}.json").is_file():
+    if _content_table is not None:
+        return _content_table.get(str(cid))
+    return await _load_content_info(str(cid))
+
+
+@AsyncLRU(maxsize=8192)
+async def _load_content_info(cid: str) -> dict[str, Any] | None:
+    info = state.get_details(cid)
+    if info is None:
         return None
-    info = {}
-    async with aiofiles.open(content_dir / f"{cid}.json") as f:
-        info.update(await json.aload(f))
-    result = content_dir / f"{cid}_crawl_result.json"
-    if result.is_file():
-        async with aiofiles.open(result) as f:
-            info.update(await json.aload(f))
+    if result := state.get_result(cid):
+        info.update(result)
     return filter_content(info)
 
 
-async def gen_products_index():
+# Files of products_work_dir/<mid> a product payload is built from
+WORK_FILES = (
+    "model_img.txt",
+    "operating_systems.json",
+    "factory_config.json",
+    "knowledge_base.json",
+    "manuals_and_specs.json",
+    "drivers.json",
+)
+
+
+def product_inputs(mid: str, context: dict[str, Any]) -> tuple[str, Callable[[], str]]:
+    """
+    Describe the inputs of a product payload, apart from the contents it references.
+
+    Returns a cheap key made of the work files sizes and mtimes, and a function computing a digest of their contents
+    and of the product context, used when the mtimes changed but the files may not have.
+    """
+    paths = [products_work_dir / mid / name for name in WORK_FILES]
+    stats = []
+    for path in paths:
+        try:
+            stat = path.stat()
+            stats.append(f"{stat.st_size}:{stat.st_mtime_ns}")
+        except FileNotFoundError:
+            stats.append("-")
+
+    def digest() -> str:
+        hasher = hashlib.sha256(json_bytes(context))
+        for path in paths:
+            if path.is_file():
+                hasher.update(path.name.encode())
+                blobstore.hash_file(path, hasher)
+        return hasher.hexdigest()
+
+    context_hash = hashlib.sha256(json_bytes(context)).hexdigest()[:16]
+    return f"{context_hash}:{','.join(stats)}", digest
+
+
+def json_bytes(obj: Any) -> bytes:
+    data = json.dumps(obj)
+    return data.encode() if isinstance(data, str) else data
+
+
+async def gen_products_index(full: bool = False, preload: bool | None = None):
+    """
+    Generate products/<mid>.json for every product.
+
+    Only products whose inputs changed since the previous run are regenerated: their work files, their entry in the
+    products list, or any content they reference (found through the content to products map in the state database).
+    Pass full to regenerate everything.
+
+    With preload, every content is loaded into memory up front instead of being looked up one by one. By default this
+    is done when more than PRELOAD_MIN_PRODUCTS products need to be regenerated.
+    """
+    global _content_table
+    started = time.time()
+
     async with aiofiles.open(data_dir / "all_products.json") as f:
         all_products = await json.aload(f)
 
@@ -61,17 +179,67 @@ async def gen_products_index():
         for family in product_type["family"]:
             families[family["fid"]] = family
 
-    progress = tqdm(total=len(flat_products), desc="Generating products indices", unit="products")
+    since = None if full else state.get_meta("products_index_at")
+    affected = state.products_with_changed_contents(since) if since is not None else set()
+
+    # Find out which products need to be regenerated
+    todo: dict[str, tuple[str, str]] = {}
+
+    async def check(mid):
+        info = flat_products[mid]
+        product_type = all_products[info["pid"]]
+        family = families[info["fid"]]
+        context = {
+            "info": info,
+            "type": [product_type["pname"], product_type["pimg"]],
+            "family": [family["fname"], family["fimg"]],
+        }
+        inputs_stat, digest = await asyncio.to_thread(product_inputs, mid, context)
+
+        manifest = state.get_product_manifest(mid)
+        if since is not None and mid not in affected and manifest and (product_dir / f"{mid}.json").is_file():
+            if manifest[0] == inputs_stat:
+                return
+            inputs_hash = await asyncio.to_thread(digest)
+            if manifest[1] == inputs_hash:
+                state.put_product_manifest(mid, inputs_stat, inputs_hash)
+                return
+        else:
+            inputs_hash = await asyncio.to_thread(digest)
+        todo[mid] = (inputs_stat, inputs_hash)
+
+    failures = await WorkerPool(10, check, return_exceptions=True).run(flat_products.keys())
+    tqdm.write(f"{len(todo)} of {len(flat_products)} products need to be regenerated")
+
+    if preload is None:
+        preload = len(todo) > PRELOAD_MIN_PRODUCTS
+    if preload and todo:
+        preload_contents()
+
+    progress = tqdm(total=len(todo), desc="Generating products indices", unit="products")
 
     async def coro(mid):
-        product_info = flat_products[mid]
-        await gen_product_index(all_products, families, product_info, mid)
+        cids = await gen_product_index(all_products, families, flat_products[mid], mid)
+        state.put_product_manifest(mid, *todo[mid], cids)
         progress.update()
 
-    await run_concurrently(10, coro, flat_products.keys())
+    start = time.perf_counter()
+    try:
+        failures += await WorkerPool(10, coro, return_exceptions=True).run(todo.keys())
+    finally:
+        _content_table = None
+    progress.close()
+    if todo:
+        elapsed = time.perf_counter() - start
+        tqdm.write(f"Regenerated {len(todo)} products in {elapsed:.2f}s ({len(todo) / elapsed:.0f} products/s)")
 
+    if not failures:
+        state.set_meta("products_index_at", started)
 
-async def gen_product_index(all_products, families, info, mid):
+
+async def gen_product_index(all_products, families, info, mid) -> set[str]:
+    """Write products/<mid>.json, returning the IDs of the contents it references."""
+    cids = set()
     product_type = all_products[info["pid"]]
     family = families[info["fid"]]
     product = {
@@ -107,6 +275,7 @@ async def gen_product_index(all_products, families, info, mid):
     async with aiofiles.open(products_work_dir / str(mid) / "knowledge_base.json") as f:
         kb = await json.aload(f)
     for item in kb:
+        cids.add(str(item["contentID"]))
         content = await get_content_info(item["contentID"])
         if content:
             item.update(content)
@@ -116,6 +285,7 @@ async def gen_product_index(all_products, families, info, mid):
     async with aiofiles.open(products_work_dir / str(mid) / "manuals_and_specs.json") as f:
         manuals_and_specs = await json.aload(f)
     for item in manuals_and_specs:
+        cids.add(str(item["contentID"]))
         content = await get_content_info(item["contentID"])
         if content:
             item.update(content)
@@ -127,6 +297,7 @@ async def gen_product_index(all_products, families, info, mid):
     product["drivers"] = drivers
 
     for _, driver in product["drivers"]["contents"].items():
+        cids.add(str(driver["contentID"]))
         content = await get_content_info(driver["contentID"])
         if content:
             driver.update(content)
@@ -136,6 +307,9 @@ async def gen_product_index(all_products, families, info, mid):
     async with aiofiles.open(product_dir / f"{mid}.json", "wb") as f:
         await json.adump(product, f)
 
+    return cids
+
 
 def cli_gen_products_index():
-    async_run(gen_products_index())
+    preload = True if cli_flag("--preload") else False if cli_flag("--no-preload") else None
+    async_run(gen_products_index(full=cli_flag("--full"), preload=preload))
@@ -1,105 +1,119 @@
+import asyncio
+import time
 from collections import defaultdict
 from pathlib import Path
+from typing import Any
 from urllib.parse import parse_qs
 
 import aiofiles
-import bs4
 from tqdm import tqdm
 
-from dynabook_scraper.utils.common import (
-    extract_json_var,
-    run_concurrently,
-    remove_null_fields,
-)
-from .utils import json
-from .utils.paths import data_dir, html_dir, products_work_dir
+from dynabook_scraper.utils.common import remove_null_fields
+from .utils import html_pack, json
+from .utils.page_scan import find_factory_config_url, find_model_img, load_json_var, scan_json_vars
+from .utils.pool import WorkerPool
+from .utils.processes import PARSE_WORKERS, get_executor
+from .utils.paths import data_dir, products_work_dir
 from .utils.uvloop import async_run
 
-CONCURRENCY = 30
+# Products being read, parsed or written at once, enough to keep every process busy
+CONCURRENCY = max(30, PARSE_WORKERS * 2)
 
 
-# noinspection JSUnresolvedReference
-async def parse_product(mid: str):
-    product_dir = products_work_dir / mid
-    product_dir.mkdir(exist_ok=True)
-
-    product_html_dir = html_dir / mid
-
-    async with aiofiles.open(product_html_dir / "base.html") as f:
-        page = await f.read()
-
-    async with aiofiles.open(product_dir / "operating_systems.json") as f:
-        os_list = await json.aload(f)
+def parse_product_html(page: bytes, os_list: list[dict], os_page: bytes | None) -> dict[str, Any]:
+    """
+    Extract everything we need from the HTML of a product. This is CPU-bound and runs in a worker process.
 
+    Returns the model image, factory configuration, manuals and specs, knowledge base and drivers of the product.
+    """
     os_map = {os_obj["osId"]: os_obj["osNameAndType"] for os_obj in os_list}
+    json_vars = scan_json_vars(page)
+    parsed = {}
 
     # Find model image
-    soup = bs4.BeautifulSoup(page, "html.parser")
-    model_img = soup.select_one(".model_img img")
-    if model_img:
-        model_img_src = model_img["src"]
-        async with aiofiles.open(product_dir / "model_img.txt", "w") as f:
-            await f.write(model_img_src)
+    if model_img := find_model_img(page):
+        parsed["model_img"] = model_img
 
     # Find factory configuration
-    factory_config_line = None
-    for line in page.splitlines():
-        if "/support/viewFactoryConfig" in line:
-            factory_config_line = line
-            break
-    if factory_config_line:
-        url = factory_config_line.split('"')[1]
+    if url := find_factory_config_url(page):
         query_string = url.split("?", 1)[1]
         query = parse_qs(query_string)
-
         mpn = query.get("mpn", ["null"])[0]
         config = query.get("config", ["null"])[0]
 
         if mpn != "null" and config != "null":
             factory_config = {"mpn": mpn, "config": {}}
-
             for entry in config.split(","):
                 kvp = entry.strip().split("=", 1)
                 if len(kvp) < 2:
                     kvp.append("")
                 factory_config["config"][kvp[0]] = kvp[1]
-
-            async with aiofiles.open(product_dir / "factory_config.json", "wb") as f:
-                await json.adump(factory_config, f)
+            parsed["factory_config"] = factory_config
 
     # Find manuals and specs
-    manuals_and_specs = remove_null_fields(extract_json_var(page, "manualsSpecsJsonArr"))
-    async with aiofiles.open(product_dir / "manuals_and_specs.json", "wb") as f:
-        await json.adump(manuals_and_specs, f)
+    parsed["manuals_and_specs"] = remove_null_fields(load_json_var(json_vars, "manualsSpecsJsonArr"))
 
     # Find knowledge base
-    kb = remove_null_fields(extract_json_var(page, "knowledgeBaseJsonArr"))
-    async with aiofiles.open(product_dir / "knowledge_base.json", "wb") as f:
-        await json.adump(kb, f)
+    parsed["knowledge_base"] = remove_null_fields(load_json_var(json_vars, "knowledgeBaseJsonArr"))
 
     # Find drivers
     driver_contents = {}
     drivers = defaultdict(list)
+    if os_page is not None:
+        for driver in remove_null_fields(load_json_var(scan_json_vars(os_page), "driversUpdatesJsonArr")):
+            content_id = str(driver["contentID"])
+            driver["tags"] = driver.get("tags", "").split(",")
+            driver["tagNames"] = driver.get("tagNames", "").split(",")
+            driver["os"] = [tag for tag in driver["tags"] if tag in os_map]
+            driver_contents[content_id] = driver
+
+            if not driver["os"]:
+                drivers["Any"].append(content_id)
+            else:
+                for os_id in driver["os"]:
+                    drivers[os_map[os_id]].append(content_id)
+    parsed["drivers"] = {"contents": driver_contents, "drivers": drivers}
+
+    return parsed
+
+
+async def parse_product(mid: str) -> list[tuple[str, dict]]:
+    """
+    Parse the scraped HTML of a product, returning the contents (drivers, manuals, articles) it lists along with the
+    kind of list they're in, as named in content_details.CONTENT_LISTS.
+    """
+    product_dir = products_work_dir / mid
+    product_dir.mkdir(exist_ok=True)
+
+    page = await html_pack.read_page(mid, "base.html")
+
+    async with aiofiles.open(product_dir / "operating_systems.json") as f:
+        os_list = await json.aload(f)
+
+    os_page = None
+    if os_list:
+        os_page = await html_pack.read_page(mid, f"os_{os_list[0]['osId']}.html")
+
+    loop = asyncio.get_running_loop()
+    parsed = await loop.run_in_executor(get_executor(), parse_product_html, page, os_list, os_page)
+
+    if "model_img" in parsed:
+        async with aiofiles.open(product_dir / "model_img.txt", "w") as f:
+            await f.write(parsed["model_img"])
 
-    if os_map:
-        first_os = os_list[0]["osId"]
-        async with aiofiles.open(product_html_dir / f"os_{first_os}.html") as f:
-            os_page = await f.read()
-            for driver in remove_null_fields(extract_json_var(os_page, "driversUpdatesJsonArr")):
-                content_id = str(driver["contentID"])
-                driver["tags"] = driver.get("tags", "").split(",")
-                driver["tagNames"] = driver.get("tagNames", "").split(",")
-                driver["os"] = [tag for tag in driver["tags"] if tag in os_map]
-                driver_contents[content_id] = driver
+    if "factory_config" in parsed:
+        async with aiofiles.open(product_dir / "factory_config.json", "wb") as f:
+            await json.adump(parsed["factory_config"], f)
 
-                if not driver["os"]:
-                    drivers["Any"].append(content_id)
-                else:
-                    for os_id in driver["os"]:
-                        drivers[os_map[os_id]].append(content_id)
+    for name in ("manuals_and_specs", "knowledge_base", "drivers"):
+        async with aiofiles.open(product_dir / f"{name}.json", "wb") as f:
+            await json.adump(parsed[name], f)
 
-    async with aiofiles.open(product_dir / "drivers.json", "wb") as f:
-        await json.adump({"contents": driver_contents, "drivers": drivers}, f)
+    return [
+        *(("drivers", content) for content in parsed["drivers"]["contents"].values()),
+        *(("knowledge base", content) for content in parsed["knowledge_base"]),
+        *(("manuals and specs", content) for content in parsed["manuals_and_specs"]),
+    ]
 
 
 async def parse_products(products_list: Path = data_dir / "all_products_flat.json"):
@@ -117,7 +131,13 @@ async def parse_products(products_list: Path = data_dir / "all_products_flat.jso
             print(f"Error parsing product {mid}: {e}")
             raise
 
-    await run_concurrently(CONCURRENCY, coro, all_products.keys())
+    start = time.perf_counter()
+    await WorkerPool(CONCURRENCY, coro).run(html_pack.pack_order(list(all_products)))
+    elapsed = time.perf_counter() - start
+    tqdm.write(
+        f"Parsed {len(all_products)} products in {elapsed:.2f}s ({len(all_products) / elapsed:.0f} products/s) "
+        f"with {PARSE_WORKERS} processes"
+    )
 
 
 def cli_parse_products_html():
@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+import hashlib
+import inspect
+import time
+import traceback
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+from urllib.parse import urlparse
+
+import aiofiles
+from tqdm import tqdm
+
+from . import content_details, contents, html
+from .assets import scrape_assets
+from .broken_links import scrape_broken_links
+from .content_details import Content, ContentDownloader, find_content_links
+from .contents import download_content, is_up_to_date, local_size
+from .frontend import build_frontend
+from .html import scrape_product_html
+from .product_index import gen_products_index
+from .products import parse_product
+from .products_list import scrape_products_list
+from .sitemap import write_sitemap
+from .utils import blobstore, http_cache, json, state
+from .utils.common import parse_duration
+from .utils.paths import data_dir, downloads_dir, product_dir, products_work_dir
+from .utils.pool import WorkerPool
+from .utils.scheduler import SizeAwareScheduler
+from .utils.uvloop import async_run
+
+
+@dataclass
+class Stage:
+    name: str
+    run: Callable[[], Awaitable[Any] | Any]
+    deps: tuple[str, ...] = ()
+    # Digest of the stage inputs, the stage is skipped if it didn't change since its last successful run. It is recorded
+    # once the stage succeeds, since some stages update their own inputs
+    fingerprint: Callable[[], str] | None = None
+
+
+def files_fingerprint(*patterns: tuple[Path, str]) -> str:
+    # Hash the contents rather than the mtimes, since most stages rewrite their outputs even when nothing changed
+    hasher = hashlib.sha256()
+    for base, pattern in patterns:
+        for path in sorted(base.glob(pattern)):
+            if path.is_file():
+                hasher.update(f"{path}\n".encode())
+                blobstore.hash_file(path, hasher)
+    return hasher.hexdigest()
+
+
+async def crawl(refresh: bool = False):
+    """
+    Scrape, parse and download every product as one stream.
+
+    Each product page is parsed as soon as it's fetched, the details of its contents are fetched as soon as they're
+    found (along with their versions and linked contents), and each content file is handed to the download scheduler
+    as soon as its details are known. This replaces running the products HTML, parsing, content details, content links
+    and download stages one after the other.
+    """
+    async with aiofiles.open(data_dir / "all_products_flat.json") as f:
+        all_products = await json.aload(f)
+
+    queue: asyncio.Queue[Content | None] = asyncio.Queue()
+    outstanding = 0
+    products_done = False
+
+    def enqueue(content: Content):
+        nonlocal outstanding
+        outstanding += 1
+        queue.put_nowait(content)
+
+    def maybe_finish():
+        if products_done and outstanding == 0:
+            queue.put_nowait(None)
+
+    async def queued_contents():
+        while (content := await queue.get()) is not None:
+            yield content
+
+    downloader = ContentDownloader(on_added=enqueue)
+    scheduler = SizeAwareScheduler(
+        contents.CONCURRENCY, desc="Downloading contents", max_pending=contents.DISCOVERY_QUEUE_SIZE
+    )
+    progress = tqdm(total=len(all_products), desc="Scraping products", unit="product")
+
+    async def process_product(mid: str):
+        await scrape_product_html(mid)
+        for kind, content in await parse_product(mid):
+            downloader.ingest(content, kind)
+        progress.update()
+
+    async def process_content(content: Content):
+        nonlocal outstanding
+        try:
+            details = await downloader.download_content_details(content)
+            if details is None:
+                return
+
+            raw = json.dumps(details)
+            for cid in find_content_links(raw.decode() if isinstance(raw, bytes) else raw):
+                downloader.ingest_link(cid)
+
+            if url := details.get("contentFile"):
+                filename = "index.html" if details["contentType"] == "scraper-swf" else Path(url).name
+                cid = details["contentID"]
+                size = await local_size(downloads_dir / str(cid) / filename)
+                if refresh or not is_up_to_date(details, state.get_result(cid), size):
+                    await scheduler.submit(details, details.get("fileSize"), urlparse(url).hostname)
+        finally:
+            outstanding -= 1
+            maybe_finish()
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(scheduler.run(lambda details: download_content(details, refresh)))
+        details_pool = WorkerPool(content_details.CONCURRENCY, process_content, return_exceptions=True)
+        details_task = tg.create_task(details_pool.run(queued_contents()))
+
+        await WorkerPool(html.CONCURRENCY, process_product, return_exceptions=True).run(all_products.keys())
+        progress.close()
+        products_done = True
+        maybe_finish()
+
+        await details_task
+        await scheduler.close()
+
+
+def build_stages(refresh: bool, base_url: str, web_prefix: str | None) -> list[Stage]:
+    templates_dir = Path(__file__).parent / "templates"
+    stages = [
+        Stage("products-list", scrape_products_list),
+        Stage("crawl", lambda: crawl(refresh), deps=("products-list",)),
+        Stage(
+            "assets",
+            scrape_assets,
+            deps=("crawl",),
+            fingerprint=lambda: files_fingerprint(
+                (data_dir, "all_products.json"), (products_work_dir, "*/model_img.txt")
+            ),
+        ),
+        Stage("broken-links", scrape_broken_links, deps=("crawl",), fingerprint=state.failures_fingerprint),
+        Stage(
+            "products-index",
+            gen_products_index,
+            deps=("broken-links",),
+            fingerprint=lambda: (
+                files_fingerprint((data_dir, "all_products*.json"), (products_work_dir, "*/*")) + state.fingerprint()
+            ),
+        ),
+        Stage("export-state", state.export_json, deps=("broken-links",)),
+        Stage(
+            "build-frontend",
+            lambda: build_frontend(base_url),
+            fingerprint=lambda: files_fingerprint((templates_dir, "**/*")) + base_url,
+        ),
+    ]
+    if web_prefix:
+        stages.append(
+            Stage(
+                "sitemap",
+                lambda: write_sitemap(web_prefix),
+                deps=("products-index", "export-state"),
+                fingerprint=lambda: files_fingerprint((product_dir, "*.json")) + state.fingerprint() + web_prefix,
+            )
+        )
+    return stages
+
+
+async def run_stages(stages: list[Stage], force: bool = False) -> set[str]:
+    """
+    Run stages as soon as all of their dependencies are done, so independent stages overlap.
+
+    Stages whose inputs didn't change since their last successful run are skipped, unless force is set. A failed
+    stage is reported and its dependents are skipped. Returns the names of the failed stages.
+    """
+    finished = {stage.name: asyncio.Event() for stage in stages}
+    failed = set()
+
+    async def run_stage(stage: Stage):
+        try:
+            for dep in stage.deps:
+                await finished[dep].wait()
+            if failed.intersection(stage.deps):
+                tqdm.write(f"[{stage.name}] skipped, a dependency failed")
+                failed.add(stage.name)
+                return
+
+            fingerprint = stage.fingerprint() if stage.fingerprint else None
+            if fingerprint and not force and state.get_meta(f"stage:{stage.name}") == fingerprint:
+                tqdm.write(f"[{stage.name}] up to date")
+                return
+
+            tqdm.write(f"[{stage.name}] started")
+            start = time.perf_counter()
+            try:
+                result = stage.run()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception:
+                traceback.print_exc()
+                tqdm.write(f"[{stage.name}] failed after {time.perf_counter() - start:.1f}s")
+                failed.add(stage.name)
+                return
+
+            if stage.fingerprint:
+                state.set_meta(f"stage:{stage.name}", stage.fingerprint())
+            tqdm.write(f"[{stage.name}] done in {time.perf_counter() - start:.1f}s")
+        finally:
+            finished[stage.name].set()
+
+    await asyncio.gather(*(run_stage(stage) for stage in stages))
+    return failed
+
+
+def cli_run():
+    parser = argparse.ArgumentParser(description="Run the whole scraping pipeline")
+    parser.add_argument("--force", action="store_true", help="run every stage even if its inputs didn't change")
+    parser.add_argument("--refresh", action="store_true", help="revalidate already downloaded contents")
+    parser.add_argument("--base-url", default="/", help="base URL of the frontend (default: /)")
+    parser.add_argument("--sitemap", metavar="WEB_PREFIX", help="also generate a sitemap for this public URL")
+    parser.add_argument("--cache-only", action="store_true", help="replay metadata from the HTTP cache only")
+    parser.add_argument(
+        "--cache-max-age", type=parse_duration, metavar="DURATION", help="refetch cached metadata older than this"
+    )
+    args = parser.parse_args()
+    http_cache.configure(args.cache_only, args.cache_max_age)
+
+    stages = build_stages(args.refresh, args.base_url, args.sitemap)
+    failed = async_run(run_stages(stages, args.force))
+    if failed:
+        raise SystemExit(f"Failed stages: {', '.join(sorted(failed))}")
@@ -4,7 +4,8 @@ from typing import Generator
 
 from tqdm import tqdm
 
-from dynabook_scraper.utils.paths import content_dir, product_dir, data_dir
+from dynabook_scraper.utils import state
+from dynabook_scraper.utils.paths import product_dir, data_dir
 
 
 def gen_sitemap_urls(web_prefix: str) -> Generator[str, None, None]:
@@ -13,10 +14,7 @@ def gen_sitemap_urls(web_prefix: str) -> Generator[str, None, None]:
     yield f"{web_prefix}/"
     yield f"{web_prefix}/eula/"
 
-    for file in tqdm(list(content_dir.iterdir()), desc="Mapping content", unit="files"):
-        if not file.is_file() or not file.name.endswith(".json") or file.name.endswith("_crawl_result.json"):
-            continue
-        cid = file.stem
+    for cid in tqdm(state.content_ids(), desc="Mapping content", unit="contents"):
         yield f"{web_prefix}/content/?contentID={cid}"
 
     for file in tqdm(list(product_dir.iterdir()), desc="Mapping products", unit="files"):
@@ -38,13 +36,15 @@ def gen_sitemap(web_prefix: str) -> Generator[str, None, None]:
     yield "</urlset>"
 
 
+def write_sitemap(web_prefix: str):
+    with open(data_dir / "sitemap.xml", "w") as f:
+        for line in gen_sitemap(web_prefix):
+            print(line, file=f)
+
+
 def cli_gen_sitemap():
     if len(sys.argv) != 2:
         print(f"Usage: {sys.argv[0]} <web_prefix>")
         sys.exit(1)
 
-    web_prefix = sys.argv[1]
-
-    with open(data_dir / "sitemap.xml", "w") as f:
-        for line in gen_sitemap(web_prefix):
-            print(line, file=f)
+    write_sitemap(sys.argv[1])
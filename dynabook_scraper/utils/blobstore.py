@@ -0,0 +1,115 @@
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+from pathlib import Path
+
+from . import json
+from .paths import blobs_dir
+
+# Linux FICLONE ioctl, used to reflink blobs on filesystems that support it when hardlinking is not possible
+FICLONE = 0x40049409
+
+_index_path = blobs_dir / "index.jsonl"
+_by_url: dict[str, tuple[str, int]] = {}
+_loaded = False
+
+
+def _load_index():
+    global _loaded
+    if _loaded:
+        return
+    _loaded = True
+
+    if not _index_path.is_file():
+        return
+
+    with open(_index_path, "rb") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Truncated line from an interrupted run
+                continue
+            if entry.get("url"):
+                _by_url[entry["url"]] = entry["sha256"], entry["size"]
+
+
+def blob_path(digest: str) -> Path:
+    return blobs_dir / digest[:2] / digest
+
+
+def hash_file(path: Path, hasher=None):
+    hasher = hasher or hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(4 * 1024 * 1024):
+            hasher.update(chunk)
+    return hasher
+
+
+def find(url: str, size: int) -> str | None:
+    """
+    Look up the blob last downloaded from url, returning its digest.
+
+    The size is the expected size of the file: a blob is only reused when it is known and matches, since the content
+    behind a URL can change. Files are only matched by URL: the content details give no hash, and a size alone doesn't
+    tell two files apart, so a byte-identical file published under another URL is downloaded again. It is still stored
+    once, store() dropping the copy.
+    """
+    _load_index()
+
+    if not size or url not in _by_url:
+        return None
+    digest, blob_size = _by_url[url]
+    if blob_size != size or not blob_path(digest).is_file():
+        return None
+    return digest
+
+
+def store(path: Path, digest: str, url: str | None = None, name: str | None = None) -> Path:
+    """Move a fully downloaded file into the store. If the blob already exists the file is discarded."""
+    _load_index()
+
+    blob = blob_path(digest)
+    if blob.is_file():
+        path.unlink()
+    else:
+        blob.parent.mkdir(exist_ok=True)
+        path.replace(blob)
+
+    size = blob.stat().st_size
+    if url and _by_url.get(url) != (digest, size):
+        _by_url[url] = digest, size
+        with open(_index_path, "a") as f:
+            json.dump({"sha256": digest, "size": size, "name": name or path.name, "url": url}, f)
+            f.write("\n")
+
+    return blob
+
+
+def _reflink(src: Path, dst: Path):
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def link(digest: str, dest: Path):
+    """Make dest point at the given blob: hardlink if possible, then reflink, then a plain copy."""
+    blob = blob_path(digest)
+    dest.parent.mkdir(exist_ok=True, parents=True)
+
+    if dest.is_file() and os.path.samefile(blob, dest):
+        return
+
+    tmp = dest.with_name(f"{dest.name}.link")
+    tmp.unlink(missing_ok=True)
+    try:
+        os.link(blob, tmp)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM, errno.ENOTSUP):
+            raise
+        try:
+            _reflink(blob, tmp)
+        except OSError:
+            shutil.copyfile(blob, tmp)
+    tmp.replace(dest)
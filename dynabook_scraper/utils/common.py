@@ -1,18 +1,48 @@
 import asyncio
 import random
 import re
+import sys
 from pathlib import Path
-from typing import Callable, Awaitable, Iterable, Any, List
+from typing import Callable
 from urllib.parse import urlparse
 
-import aiofiles
 import aiohttp
 import duckduckgo_search.exceptions
 from multidict import MultiMapping
 from tqdm import tqdm
 
-from . import json
-from .paths import content_dir, downloads_dir
+from . import json, state
+from .paths import downloads_dir
+
+
+def cli_flag(name: str) -> bool:
+    """Check whether --name was passed on the command line, removing it so positional arguments keep working."""
+    if name in sys.argv[1:]:
+        sys.argv.remove(name)
+        return True
+    return False
+
+
+def cli_option(name: str) -> str | None:
+    """Get the value of --name VALUE or --name=VALUE from the command line, removing it like cli_flag."""
+    for i, arg in enumerate(sys.argv[1:], start=1):
+        if arg == name and i + 1 < len(sys.argv):
+            value = sys.argv[i + 1]
+            del sys.argv[i : i + 2]
+            return value
+        if arg.startswith(f"{name}="):
+            del sys.argv[i]
+            return arg.split("=", 1)[1]
+    return None
+
+
+def parse_duration(value: str) -> float:
+    """Parse a duration such as 90 (seconds), 30m, 12h, 7d or 2w into seconds."""
+    units = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "w": 7 * 24 * 60 * 60}
+    value = value.strip().lower()
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
 
 
 def extract_json_var(script: str, var_name: str):
@@ -24,26 +54,11 @@ def extract_json_var(script: str, var_name: str):
     return json.loads(var)
 
 
-async def run_concurrently[T](
-    parallel: int,
-    func: Callable[..., Awaitable[T]],
-    args_iter: Iterable[Any],
-) -> List[T]:
-    semaphore = asyncio.Semaphore(parallel)
-
-    async def worker(arg: Any) -> T:
-        async with semaphore:
-            return await func(arg)
-
-    tasks = [asyncio.create_task(worker(arg)) for arg in args_iter]
-    results = await asyncio.gather(*tasks)
-    return results
-
-
 async def _handle_ratelimit(e: Exception, iteration: int, headers: MultiMapping[str] | None = None):
     tqdm.write(f"Rate limited: {e} - attempt: {iteration + 1}")
     if headers and "Retry-After" in headers:
-        await asyncio.sleep(int(headers["Retry-After"]))
+        # The host throttle holds every request to this host until Retry-After expires
+        return
     else:
         await asyncio.sleep(2 ** (iteration + 1) + random.randint(0, 10000) / 1000)
 
@@ -57,6 +72,7 @@ def http_retry[T](fn: Callable[..., T]) -> Callable[..., T]:
             except (
                 aiohttp.ClientConnectorError,
                 aiohttp.ConnectionTimeoutError,
+                aiohttp.ClientPayloadError,
                 TimeoutError,
                 asyncio.TimeoutError,
             ) as e:
@@ -78,45 +94,6 @@ def http_retry[T](fn: Callable[..., T]) -> Callable[..., T]:
     return wrapper
 
 
-@http_retry
-async def download_file(
-    url: str,
-    out_dir: Path,
-    out_filename: str | None = None,
-    skip_existing: bool = False,
-    session: aiohttp.ClientSession = None,
-    size: int = 0,
-):
-    out_dir.mkdir(exist_ok=True, parents=True)
-    filename = out_filename or Path(url).name
-
-    if skip_existing and (out_dir / filename).is_file():
-        return
-
-    session = session or aiohttp.ClientSession()
-    async with session:
-        try:
-            async with session.get(url) as response:
-                response.raise_for_status()
-                size = int(response.headers.get("Content-Length", size))
-
-                with tqdm(
-                    total=size,
-                    unit="B",
-                    unit_scale=True,
-                    unit_divisor=1024,
-                    desc=f"Downloading {filename[-30:]}",
-                    leave=False,
-                ) as progress_bar:
-                    async with aiofiles.open(out_dir / filename, "wb") as f:
-                        async for chunk in response.content.iter_chunked(1024):
-                            await f.write(chunk)
-                            progress_bar.update(len(chunk))
-        except aiohttp.ClientPayloadError as e:
-            e.status = 999
-            e.request_info = response.request_info
-
-
 def remove_null_fields[T](obj: T) -> T:
     if isinstance(obj, list):
         return [remove_null_fields(i) for i in obj]
@@ -138,5 +115,4 @@ async def write_result_file(cid: str, url: str, status_code: int, filename: str,
         result["url"] = f"assets/content/{cid}/{filename}"
         result["actual_size"] = Path(downloads_dir / f"{cid}/{filename}").stat().st_size
 
-    async with aiofiles.open(content_dir / f"{cid}_crawl_result.json", "w") as f:
-        await json.adump(result, f)
+    state.put_result(result)
@@ -0,0 +1,370 @@
+import asyncio
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable
+
+import aiohttp
+from multidict import CIMultiDict
+from tqdm import tqdm
+
+from . import blobstore, http, json
+from .common import http_retry
+from .scheduler import throttle_bandwidth
+
+# Size of the reads from the socket and of the buffer accumulated before hitting the disk
+READ_SIZE = int(os.environ.get("DOWNLOAD_READ_SIZE", 256 * 1024))
+WRITE_BUFFER_SIZE = int(os.environ.get("DOWNLOAD_WRITE_BUFFER_SIZE", 4 * 1024 * 1024))
+# Minimum time between progress bar refreshes, in seconds
+PROGRESS_INTERVAL = 0.5
+
+# Files larger than this are split into Range segments fetched in parallel, if the server supports it
+SEGMENT_THRESHOLD = int(os.environ.get("DOWNLOAD_SEGMENT_THRESHOLD", 64 * 1024 * 1024))
+SEGMENTS_PER_FILE = int(os.environ.get("DOWNLOAD_SEGMENTS_PER_FILE", 4))
+# Maximum number of additional segment connections across all downloads
+MAX_SEGMENTS = int(os.environ.get("DOWNLOAD_MAX_SEGMENTS", 16))
+# Minimum time between two saves of the progress of a segmented download, in seconds
+SEGMENTS_SAVE_INTERVAL = 1.0
+
+# All file writes go through a single thread, so that the event loop never blocks on disk I/O and downloads don't
+# fight over the default executor
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="download-writer")
+
+_segment_slots: dict[asyncio.AbstractEventLoop, asyncio.Semaphore] = {}
+# URLs whose server stopped honoring Range requests midway, they are only downloaded as a single stream
+_no_segments: set[str] = set()
+
+
+class _RangeNotHonored(Exception):
+    pass
+
+
+def _content_range_total(header: str | None) -> int | None:
+    # bytes 100-199/2000 or bytes */2000
+    if not header or "/" not in header:
+        return None
+    total = header.rsplit("/", 1)[1].strip()
+    return int(total) if total.isdigit() else None
+
+
+def _validators(headers: CIMultiDict[str], total: int) -> dict[str, Any]:
+    validators = {
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "content_length": total or None,
+    }
+    return {k: v for k, v in validators.items() if v}
+
+
+@http_retry
+async def fetch_validators(url: str) -> dict[str, Any]:
+    """Fetch the ETag, Last-Modified and Content-Length of a remote file with a HEAD request."""
+    async with http.head(url, headers={"Accept-Encoding": "identity"}, allow_redirects=True) as response:
+        # Some servers don't implement HEAD, the caller will fall back to a regular download
+        if response.status >= 400 and response.status != 429:
+            return {}
+        response.raise_for_status()
+        return _validators(response.headers, int(response.headers.get("Content-Length", 0)))
+
+
+async def _write_stream(
+    response: aiohttp.ClientResponse,
+    write: Callable[[bytes], Any],
+    progress_bar: tqdm,
+    limit: int | None = None,
+):
+    """Read the response body in large chunks and hand coalesced buffers to write() in the writer thread."""
+    loop = asyncio.get_running_loop()
+    buffer = bytearray()
+    pending: asyncio.Future | None = None
+
+    async def flush():
+        nonlocal buffer, pending
+        if pending is not None:
+            await pending
+        data, buffer = bytes(buffer), bytearray()
+        # Let the writer thread handle this buffer while we keep reading into a new one
+        pending = loop.run_in_executor(_writer, write, data)
+        progress_bar.update(len(data))
+
+    try:
+        async for chunk in response.content.iter_chunked(READ_SIZE):
+            if limit is not None:
+                chunk = chunk[:limit]
+                limit -= len(chunk)
+            await throttle_bandwidth(len(chunk))
+            buffer += chunk
+            if len(buffer) >= WRITE_BUFFER_SIZE:
+                await flush()
+            if limit == 0:
+                break
+    finally:
+        if buffer:
+            await flush()
+        if pending is not None:
+            await pending
+
+
+def _segments_path(part_path: Path) -> Path:
+    return part_path.with_name(f"{part_path.name}.segments")
+
+
+def _plan_segments(total: int) -> list[list[int]]:
+    # [start, end (inclusive), next byte to fetch]
+    step = -(-total // SEGMENTS_PER_FILE)
+    return [[start, min(start + step, total) - 1, start] for start in range(0, total, step)]
+
+
+def _get_segment_slots() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    if loop not in _segment_slots:
+        _segment_slots[loop] = asyncio.Semaphore(MAX_SEGMENTS)
+    return _segment_slots[loop]
+
+
+async def _fetch_segment(
+    url: str,
+    fd: int,
+    segment: list[int],
+    headers: CIMultiDict[str],
+    progress_bar: tqdm,
+    on_written: Callable[[], Any],
+):
+    start, end, pos = segment
+    if pos > end:
+        return
+
+    def write(data: bytes):
+        os.pwrite(fd, data, segment[2])
+        segment[2] += len(data)
+        on_written()
+
+    async with _get_segment_slots():
+        range_headers = {"Accept-Encoding": "identity", "Range": f"bytes={pos}-{end}"}
+        async with http.get(url, headers=range_headers) as response:
+            response.raise_for_status()
+            if response.status != 206:
+                raise _RangeNotHonored(url)
+            headers.update(response.headers)
+            await _write_stream(response, write, progress_bar, limit=end - pos + 1)
+
+
+async def _download_segmented(
+    url: str,
+    part_path: Path,
+    total: int,
+    progress_bar: tqdm,
+) -> CIMultiDict[str]:
+    """
+    Fetch a file as parallel Range segments written in place into the .part file.
+
+    The progress of each segment is saved every SEGMENTS_SAVE_INTERVAL in a ``.segments`` file next to it, so that an
+    interrupted download only fetches the missing ranges. The file is written before the .part file is preallocated,
+    and only ever records bytes already flushed to disk. Returns the headers of one of the responses. Raises
+    _RangeNotHonored if a segment is answered with anything else than a 206.
+    """
+    segments_path = _segments_path(part_path)
+    segments = None
+    if segments_path.is_file() and part_path.is_file():
+        state = json.loads(segments_path.read_bytes())
+        if state["total"] == total:
+            segments = state["segments"]
+    if segments is None:
+        segments = _plan_segments(total)
+        part_path.unlink(missing_ok=True)
+
+    progress_bar.update(sum(pos - start for start, _, pos in segments) - progress_bar.n)
+
+    headers = CIMultiDict()
+    last_save = 0.0
+
+    def save():
+        nonlocal last_save
+        os.fdatasync(fd)
+        tmp = segments_path.with_name(f"{segments_path.name}.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"total": total, "segments": segments}, f)
+        tmp.replace(segments_path)
+        last_save = time.monotonic()
+
+    def on_written():
+        # Runs in the writer thread, after the data is written
+        if time.monotonic() - last_save >= SEGMENTS_SAVE_INTERVAL:
+            save()
+
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        save()
+        os.ftruncate(fd, total)
+        results = await asyncio.gather(
+            *(_fetch_segment(url, fd, segment, headers, progress_bar, on_written) for segment in segments),
+            return_exceptions=True,
+        )
+    finally:
+        # Queued behind the pending writes, if any
+        _writer.submit(save).result()
+        os.close(fd)
+
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+    segments_path.unlink()
+    return headers
+
+
+@http_retry
+async def download_file(
+    url: str,
+    out_dir: Path,
+    out_filename: str | None = None,
+    skip_existing: bool = False,
+    size: int = 0,
+    validators: dict[str, Any] | None = None,
+) -> dict[str, Any]:
+    """
+    Download a file into out_dir.
+
+    Data is streamed into a ``.part`` file which is only moved into the blob store once its length matches the
+    Content-Length (or the expected size, if the server doesn't send one), and the destination becomes a link to the
+    blob. If a ``.part`` file is left over by a failed attempt, the download is resumed with a Range request. Files
+    larger than SEGMENT_THRESHOLD are fetched as parallel Range segments when the server accepts ranges, into a
+    separate ``.segmented.part`` file: it is preallocated, so its size says nothing about what was fetched, and it is
+    discarded if its progress file is missing. A file already downloaded from the same URL is not downloaded again if
+    its size matches the expected size.
+
+    When validators from a previous crawl result are given and the file already exists, the request is made
+    conditional (If-None-Match/If-Modified-Since) and the body is only transferred if the remote file changed.
+
+    Returns information about the downloaded file (digest, validators) to be recorded in the crawl result.
+    """
+    out_dir.mkdir(exist_ok=True, parents=True)
+    filename = out_filename or Path(url).name
+    out_path = out_dir / filename
+    part_path = out_dir / f"{filename}.part"
+    segmented_path = out_dir / f"{filename}.segmented.part"
+
+    if skip_existing and out_path.is_file():
+        return {}
+
+    if validators is None and (digest := blobstore.find(url, size)):
+        blobstore.link(digest, out_path)
+        return {"sha256": digest}
+
+    progress_bar = tqdm(
+        unit="B",
+        unit_scale=True,
+        unit_divisor=1024,
+        desc=f"Downloading {filename[-30:]}",
+        leave=False,
+        mininterval=PROGRESS_INTERVAL,
+    )
+    hasher = None
+    response = None
+    segmented = single_stream_fallback = False
+    try:
+        with progress_bar:
+            if _segments_path(segmented_path).is_file() and segmented_path.is_file():
+                # Resume an interrupted segmented download
+                total = json.loads(_segments_path(segmented_path).read_bytes())["total"]
+                progress_bar.reset(total)
+                segmented = True
+            else:
+                # Without its progress there is no telling the fetched ranges of a segmented download from the holes
+                segmented_path.unlink(missing_ok=True)
+                _segments_path(segmented_path).unlink(missing_ok=True)
+                hasher = hashlib.sha256()
+                offset = part_path.stat().st_size if part_path.is_file() else 0
+                # Ask for the raw bytes, otherwise Content-Length and Range refer to the compressed stream
+                request_headers = {"Accept-Encoding": "identity"}
+                if offset:
+                    request_headers["Range"] = f"bytes={offset}-"
+                elif validators and out_path.is_file():
+                    if "etag" in validators:
+                        request_headers["If-None-Match"] = validators["etag"]
+                    if "last_modified" in validators:
+                        request_headers["If-Modified-Since"] = validators["last_modified"]
+
+                async with http.get(url, headers=request_headers) as response:
+                    headers = response.headers
+                    if response.status == 304:
+                        keep = ("sha256", "etag", "last_modified", "content_length")
+                        return {k: validators[k] for k in keep if k in validators} | _validators(headers, 0)
+
+                    if response.status == 416 and offset:
+                        # The .part file is either already complete or does not belong to this file anymore
+                        total = _content_range_total(headers.get("Content-Range"))
+                        if total != offset:
+                            part_path.unlink()
+                            raise aiohttp.ClientPayloadError(
+                                f"Partial download of {filename} does not match the remote file"
+                            )
+                        hasher = None
+                    else:
+                        response.raise_for_status()
+
+                        if response.status == 206:
+                            total = _content_range_total(headers.get("Content-Range")) or size
+                            mode = "ab"
+                            await asyncio.to_thread(blobstore.hash_file, part_path, hasher)
+                        else:
+                            # The server ignored the Range header, start over
+                            total = int(headers.get("Content-Length", size))
+                            offset = 0
+                            mode = "wb"
+
+                        progress_bar.reset(total)
+                        if (
+                            response.status == 200
+                            and total >= SEGMENT_THRESHOLD
+                            and SEGMENTS_PER_FILE > 1
+                            and headers.get("Accept-Ranges") == "bytes"
+                            and url not in _no_segments
+                        ):
+                            # The segments are fetched once this response is closed, so that it doesn't hold on to
+                            # a slot of the host while they wait for theirs
+                            hasher = None
+                            segmented = True
+                            part_path.unlink(missing_ok=True)
+                        else:
+                            progress_bar.update(offset)
+                            with open(part_path, mode, buffering=0) as f:
+
+                                def write(data: bytes):
+                                    f.write(data)
+                                    hasher.update(data)
+
+                                await _write_stream(response, write, progress_bar)
+
+            if segmented:
+                try:
+                    headers = await _download_segmented(url, segmented_path, total, progress_bar)
+                except _RangeNotHonored:
+                    tqdm.write(f"Range requests not honored for {url}, downloading it as a single stream")
+                    _no_segments.add(url)
+                    segmented_path.unlink(missing_ok=True)
+                    _segments_path(segmented_path).unlink(missing_ok=True)
+                    single_stream_fallback = True
+
+        if single_stream_fallback:
+            return await download_file(url, out_dir, out_filename, skip_existing, size, validators)
+
+        if segmented:
+            part_path = segmented_path
+        written = part_path.stat().st_size
+        if total and written != total:
+            raise aiohttp.ClientPayloadError(f"Incomplete download of {filename}: {written}/{total} bytes")
+
+        if hasher is None:
+            hasher = await asyncio.to_thread(blobstore.hash_file, part_path)
+
+        digest = hasher.hexdigest()
+        blobstore.store(part_path, digest, url=url, name=filename)
+        blobstore.link(digest, out_path)
+        return {"sha256": digest, **_validators(headers, written)}
+    except aiohttp.ClientPayloadError as e:
+        e.status = 999
+        e.request_info = response.request_info if response is not None else http.request_info_for(url)
+        raise
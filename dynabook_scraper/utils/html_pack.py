@@ -0,0 +1,119 @@
+"""
+Append-only, compressed storage for the scraped product pages.
+
+Pages are compressed one by one (zstd frames, or zlib streams when zstandard isn't installed) and appended to
+work/html/pages-<n>.pack, a new pack being started every PACK_SIZE bytes. Their location is kept in the html_pages
+table of the state database. Rewriting an unchanged page is a no-op; a changed page is appended again and the previous
+copy becomes garbage. Pages scraped before packs existed are still read from work/html/<mid>/<name>.
+"""
+
+import asyncio
+import hashlib
+import os
+import zlib
+from typing import BinaryIO
+
+from . import state
+from .paths import html_dir
+
+try:
+    # noinspection PyUnresolvedReferences
+    import zstandard
+
+    zstd_available = True
+except ImportError:
+    zstd_available = False
+
+# Size after which a new pack is started
+PACK_SIZE = 256 * 1024**2
+ZSTD_LEVEL = 9
+ZLIB_LEVEL = 6
+
+_writer: tuple[str, BinaryIO] | None = None
+_readers: dict[str, int] = {}
+
+
+def _compress(data: bytes) -> tuple[str, bytes]:
+    if zstd_available:
+        return "zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return "zlib", zlib.compress(data, ZLIB_LEVEL)
+
+
+def _decompress(codec: str, frame: bytes) -> bytes:
+    if codec == "zstd":
+        if not zstd_available:
+            raise RuntimeError("This page was packed with zstd, install zstandard to read it")
+        return zstandard.ZstdDecompressor().decompress(frame)
+    return zlib.decompress(frame)
+
+
+def _open_writer() -> tuple[str, BinaryIO]:
+    global _writer
+    if _writer is None:
+        packs = sorted(html_dir.glob("pages-*.pack"))
+        if packs and packs[-1].stat().st_size < PACK_SIZE:
+            path = packs[-1]
+        else:
+            path = html_dir / f"pages-{len(packs):05}.pack"
+        _writer = path.name, open(path, "ab")
+    return _writer
+
+
+def _close_writer():
+    global _writer
+    if _writer is not None:
+        _writer[1].close()
+        _writer = None
+
+
+def _read_frame(pack: str, offset: int, length: int, codec: str) -> bytes:
+    if pack not in _readers:
+        _readers[pack] = os.open(html_dir / pack, os.O_RDONLY)
+    return _decompress(codec, os.pread(_readers[pack], length, offset))
+
+
+async def write_page(mid: str, name: str, data: bytes):
+    digest = hashlib.sha256(data).hexdigest()
+    entry = state.get_html_page(mid, name)
+    if entry and entry[4] == digest:
+        return
+
+    codec, frame = await asyncio.to_thread(_compress, data)
+    # Appends happen on the event loop thread, so they can't interleave
+    pack, f = _open_writer()
+    offset = f.tell()
+    f.write(frame)
+    f.flush()
+    state.put_html_page(mid, name, pack, offset, len(frame), codec, digest)
+    if offset + len(frame) >= PACK_SIZE:
+        _close_writer()
+
+
+async def read_page(mid: str, name: str) -> bytes:
+    """Read and decompress a page, from its pack or from the unpacked work/html/<mid>/<name>."""
+    entry = state.get_html_page(mid, name)
+    if entry is None:
+        return await asyncio.to_thread((html_dir / mid / name).read_bytes)
+    pack, offset, length, codec, _ = entry
+    return await asyncio.to_thread(_read_frame, pack, offset, length, codec)
+
+
+def has_page(mid: str, name: str) -> bool:
+    """Whether a page was scraped, into a pack or into the unpacked work/html/<mid>/<name>."""
+    if state.get_html_page(mid, name):
+        return True
+    path = html_dir / mid / name
+    return path.is_file() and path.stat().st_size > 0
+
+
+def page_names(mid: str) -> list[str]:
+    names = set(state.html_page_names(mid))
+    if (html_dir / mid).is_dir():
+        names.update(path.name for path in (html_dir / mid).glob("*.html"))
+    return sorted(names)
+
+
+def pack_order(mids: list[str], name: str = "base.html") -> list[str]:
+    """Sort mids by where their page is stored, so that reading them in this order streams through the packs."""
+    positions = state.html_page_positions(name)
+    return sorted(mids, key=lambda mid: positions.get(mid, ("", -1)))
@@ -0,0 +1,115 @@
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from urllib.parse import urlparse
+
+import aiohttp
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from .throttle import HostThrottle
+
+# Connection pool defaults, can be overridden through the environment
+CONNECTION_LIMIT = int(os.environ.get("HTTP_CONNECTION_LIMIT", 200))
+DEFAULT_HOST_LIMIT = int(os.environ.get("HTTP_HOST_LIMIT", 10))
+DNS_CACHE_TTL = int(os.environ.get("HTTP_DNS_CACHE_TTL", 600))
+KEEPALIVE_TIMEOUT = int(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", 60))
+
+# Send every request to a local stand-in instead (see benchmarks/fake_upstream.py): https://host/path becomes
+# $HTTP_UPSTREAM_OVERRIDE/host/path
+UPSTREAM_OVERRIDE = os.environ.get("HTTP_UPSTREAM_OVERRIDE", "").rstrip("/")
+
+# Maximum number of concurrent connections per host, the actual parallelism is adjusted by HostThrottle
+HOST_LIMITS = {
+    "support.dynabook.com": 20,
+    "content.us.dynabook.com": 20,
+    "archive.org": 5,
+    "timetravel.mementoweb.org": 5,
+}
+
+# HTTP_HOST_LIMITS="archive.org=10,support.dynabook.com=30"
+for _entry in filter(None, os.environ.get("HTTP_HOST_LIMITS", "").split(",")):
+    _host, _limit = _entry.split("=", 1)
+    HOST_LIMITS[_host.strip()] = int(_limit)
+
+_session: aiohttp.ClientSession | None = None
+_host_throttles: dict[str, HostThrottle] = {}
+
+
+def host_limit(host: str) -> int:
+    if host in HOST_LIMITS:
+        return HOST_LIMITS[host]
+    # *.archive.org mirrors share the archive.org limit
+    for known_host, limit in HOST_LIMITS.items():
+        if host.endswith(f".{known_host}"):
+            return limit
+    return DEFAULT_HOST_LIMIT
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Return the process-wide HTTP session, creating it on first use."""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=CONNECTION_LIMIT,
+            limit_per_host=max(HOST_LIMITS.values(), default=DEFAULT_HOST_LIMIT),
+            use_dns_cache=True,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+        )
+        _session = aiohttp.ClientSession(connector=connector)
+        _host_throttles.clear()
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def host_throttle(host: str) -> HostThrottle:
+    if host not in _host_throttles:
+        _host_throttles[host] = HostThrottle(host, host_limit(host))
+    return _host_throttles[host]
+
+
+def request_info_for(url: str, method: str = "GET") -> aiohttp.RequestInfo:
+    """Build a RequestInfo for errors that are not tied to an actual response."""
+    return aiohttp.RequestInfo(URL(url), method, CIMultiDictProxy(CIMultiDict()), URL(url))
+
+
+@asynccontextmanager
+async def request(method: str, url: str, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+    """Perform a request through the shared session, respecting the adaptive per-host concurrency limit."""
+    session = get_session()
+    parsed = urlparse(url)
+    throttle = host_throttle(parsed.hostname or "")
+    if UPSTREAM_OVERRIDE:
+        url = f"{UPSTREAM_OVERRIDE}/{parsed.netloc}{url.split(parsed.netloc, 1)[1]}"
+
+    await throttle.acquire()
+    try:
+        start = time.monotonic()
+        try:
+            response = await session.request(method, url, **kwargs)
+        except (aiohttp.ClientConnectionError, TimeoutError):
+            throttle.on_error()
+            raise
+        throttle.on_response(response.status, time.monotonic() - start, response.headers.get("Retry-After"))
+        try:
+            yield response
+        finally:
+            response.release()
+    finally:
+        await throttle.release()
+
+
+def get(url: str, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def head(url: str, **kwargs):
+    return request("HEAD", url, **kwargs)
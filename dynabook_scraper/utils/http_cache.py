@@ -0,0 +1,151 @@
+import os
+import sqlite3
+import time
+import zlib
+from dataclasses import dataclass, field
+from typing import Any
+from urllib.parse import urlparse
+
+import aiohttp
+
+from . import json, http
+from .common import cli_flag, cli_option, parse_duration
+from .paths import work_dir
+
+DAY = 24 * 60 * 60
+
+# Cache lifetime in seconds per endpoint, matched against the URL path. None means the entry never expires.
+TTLS: dict[str, float | None] = {
+    "/drivers": DAY,
+    "/support/modelHome": 7 * DAY,
+    "/support/contentDetail": 30 * DAY,
+    "/support/staticContentDetail": 30 * DAY,
+    # Archive listings never change
+    "/view_archive.php": None,
+}
+DEFAULT_TTL = DAY
+
+# Replay mode: only serve responses from the cache and never hit the network
+_cache_only = os.environ.get("HTTP_CACHE_ONLY") == "1"
+# Cached responses older than this (in seconds) are fetched again whatever the TTL of their endpoint
+_max_age = parse_duration(os.environ["HTTP_CACHE_MAX_AGE"]) if os.environ.get("HTTP_CACHE_MAX_AGE") else None
+
+_db: sqlite3.Connection | None = None
+
+
+def _get_db() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(work_dir / "http_cache.sqlite", isolation_level=None)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                status INTEGER NOT NULL,
+                content_type TEXT,
+                body BLOB NOT NULL,
+                fetched_at REAL NOT NULL
+            )
+            """
+        )
+    return _db
+
+
+@dataclass
+class CachedResponse:
+    url: str
+    status: int
+    content_type: str
+    body: bytes = field(repr=False)
+    fetched_at: float
+
+    @property
+    def request_info(self) -> aiohttp.RequestInfo:
+        return http.request_info_for(self.url)
+
+    def text(self) -> str:
+        charset = "utf-8"
+        if "charset=" in self.content_type:
+            charset = self.content_type.split("charset=", 1)[1].split(";")[0].strip()
+        return self.body.decode(charset, errors="replace")
+
+    def json(self) -> Any:
+        # Same behavior as aiohttp.ClientResponse.json()
+        if "json" not in self.content_type:
+            raise aiohttp.ContentTypeError(
+                self.request_info, (), message=f"Attempt to decode JSON with unexpected mimetype: {self.content_type}"
+            )
+        return json.loads(self.body)
+
+
+def configure(cache_only: bool = False, max_age: float | None = None):
+    """Switch to replay mode and/or lower the maximum age of the cached responses, for the rest of the run."""
+    global _cache_only, _max_age
+    _cache_only = _cache_only or cache_only
+    if max_age is not None:
+        _max_age = max_age if _max_age is None else min(_max_age, max_age)
+
+
+def cli_configure():
+    """Apply the --cache-only and --cache-max-age DURATION options of the command line."""
+    max_age = cli_option("--cache-max-age")
+    configure(cli_flag("--cache-only"), parse_duration(max_age) if max_age else None)
+
+
+def ttl_for(url: str) -> float | None:
+    path = urlparse(url).path
+    ttl = DEFAULT_TTL
+    for prefix, endpoint_ttl in TTLS.items():
+        if path.startswith(prefix):
+            ttl = endpoint_ttl
+            break
+    if _max_age is not None:
+        return _max_age if ttl is None else min(ttl, _max_age)
+    return ttl
+
+
+def lookup(url: str) -> CachedResponse | None:
+    rows = _get_db().execute("SELECT status, content_type, body, fetched_at FROM responses WHERE url = ?", (url,))
+    row = rows.fetchone()
+    if not row:
+        return None
+    status, content_type, body, fetched_at = row
+    return CachedResponse(url, status, content_type or "", zlib.decompress(body), fetched_at)
+
+
+def store(response: CachedResponse):
+    _get_db().execute(
+        "INSERT OR REPLACE INTO responses (url, status, content_type, body, fetched_at) VALUES (?, ?, ?, ?, ?)",
+        (response.url, response.status, response.content_type, zlib.compress(response.body), response.fetched_at),
+    )
+
+
+async def cached_get(url: str, expect_json: bool = False) -> CachedResponse:
+    """
+    GET a URL through the persistent response cache.
+
+    Successful responses are stored compressed in work/http_cache.sqlite and reused until the TTL of their endpoint
+    (see TTLS) or the --cache-max-age expires. With expect_json, a response is only stored if it decodes, so that
+    error pages served with a 200 are fetched again. In --cache-only mode the network is never used and misses raise
+    a 504, like ``Cache-Control: only-if-cached`` would.
+    """
+    ttl = ttl_for(url)
+    cached = lookup(url)
+    if cached and (_cache_only or ttl is None or time.time() - cached.fetched_at < ttl):
+        return cached
+
+    if _cache_only:
+        raise aiohttp.ClientResponseError(http.request_info_for(url), (), status=504, message="Not in the HTTP cache")
+
+    async with http.get(url) as response:
+        response.raise_for_status()
+        body = await response.read()
+        cached = CachedResponse(url, response.status, response.headers.get("Content-Type", ""), body, time.time())
+
+    if expect_json:
+        # Raises like the caller would, without storing the response
+        cached.json()
+    store(cached)
+    return cached
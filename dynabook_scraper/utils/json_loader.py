@@ -0,0 +1,38 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+from . import json
+
+# Reading many small files is bound by syscalls, which release the GIL
+WORKERS = 16
+
+
+def _load(path: Path) -> Any:
+    with open(path, "rb") as f:
+        return json.load(f)
+
+
+def _result(path: Path, future: Future) -> tuple[Path, Any]:
+    try:
+        return path, future.result()
+    except Exception as e:
+        e.add_note(f"While loading {path}")
+        raise
+
+
+def load_json_files(paths: Iterable[Path], workers: int = WORKERS) -> Iterator[tuple[Path, Any]]:
+    """
+    Read and decode JSON files in a thread pool, yielding (path, object) in the order of paths.
+
+    Only a few files per thread are read ahead, so the objects are handed out as a stream instead of all at once.
+    """
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="json-loader") as executor:
+        window: deque[tuple[Path, Future]] = deque()
+        for path in paths:
+            window.append((path, executor.submit(_load, path)))
+            if len(window) >= workers * 4:
+                yield _result(*window.popleft())
+        while window:
+            yield _result(*window.popleft())
@@ -0,0 +1,80 @@
+import functools
+import html
+import re
+from typing import Any
+
+from . import json
+
+_json_var_re = re.compile(rb"var\s+(\w+)\s*=\s*eval\(")
+_model_img_re = re.compile(rb"""<(\w+)[^>]*?\sclass\s*=\s*["'](?:[^"']*\s)?model_img(?:\s[^"']*)?["'][^>]*>""")
+_img_src_re = re.compile(rb"""<img\b[^>]*?\ssrc\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+_factory_config_needle = b"/support/viewFactoryConfig"
+_void_tags = {b"area", b"base", b"br", b"col", b"embed", b"hr", b"img", b"input", b"link", b"meta", b"source", b"wbr"}
+
+
+@functools.cache
+def _tag_re(tag: bytes) -> re.Pattern[bytes]:
+    return re.compile(rb"<(/?)" + re.escape(tag) + rb"\b[^>]*?(/?)>", re.IGNORECASE)
+
+
+def _element_end(page: bytes, tag: bytes, start: int) -> int:
+    """Position of the tag closing an element whose start tag ends at start, counting nested elements of its kind."""
+    depth = 1
+    for match in _tag_re(tag).finditer(page, start):
+        if match.group(1):
+            depth -= 1
+            if depth == 0:
+                return match.start()
+        elif not match.group(2):
+            depth += 1
+    return len(page)
+
+
+def scan_json_vars(page: bytes) -> dict[str, bytes]:
+    """
+    Find every ``var X = eval(...);`` of a page in one pass.
+
+    Returns the payload of the first occurrence of each variable as a byte slice that can be handed to json.loads.
+    Like extract_json_var, a payload ends at the first ``);`` after its ``eval(``.
+    """
+    json_vars = {}
+    for match in _json_var_re.finditer(page):
+        name = match.group(1).decode()
+        if name in json_vars:
+            continue
+        end = page.find(b");", match.end())
+        if end != -1:
+            json_vars[name] = page[match.end() : end]
+    return json_vars
+
+
+def load_json_var(json_vars: dict[str, bytes], name: str) -> Any:
+    if name not in json_vars:
+        raise ValueError(f"Could not find JSON variable {name}")
+    return json.loads(json_vars[name])
+
+
+def find_model_img(page: bytes) -> str | None:
+    """The src of the first image in a .model_img element, like select_one(".model_img img"), without building a DOM."""
+    # Look for the literal class name first, matching the whole tag around each hit is much cheaper than a full search
+    pos = page.find(b"model_img")
+    while pos != -1:
+        match = _model_img_re.match(page, page.rfind(b"<", 0, pos))
+        tag = match.group(1).lower() if match and match.end() > pos else None
+        if tag and tag not in _void_tags and not match.group(0).endswith(b"/>"):
+            img = _img_src_re.search(page, match.end(), _element_end(page, tag, match.end()))
+            if img:
+                return html.unescape((img.group(1) if img.group(1) is not None else img.group(2)).decode())
+        pos = page.find(b"model_img", pos + 1)
+    return None
+
+
+def find_factory_config_url(page: bytes) -> str | None:
+    """The first quoted string of the first line linking to the factory configuration."""
+    start = page.find(_factory_config_needle)
+    if start == -1:
+        return None
+    line_start = max(page.rfind(b"\n", 0, start), page.rfind(b"\r", 0, start)) + 1
+    line_end = min((i for i in (page.find(b"\n", start), page.find(b"\r", start)) if i != -1), default=len(page))
+    parts = page[line_start:line_end].split(b'"')
+    return parts[1].decode() if len(parts) > 1 else None
@@ -24,3 +24,6 @@ content_dir.mkdir(exist_ok=True)
 
 downloads_dir = assets_dir / "content"
 downloads_dir.mkdir(exist_ok=True)
+
+blobs_dir = data_dir / "blobs"
+blobs_dir.mkdir(exist_ok=True)
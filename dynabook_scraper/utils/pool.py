@@ -0,0 +1,117 @@
+import asyncio
+from contextlib import aclosing
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable
+
+from tqdm import tqdm
+
+_DONE = object()
+
+
+async def _aiter[T](items: Iterable[T] | AsyncIterable[T]) -> AsyncIterator[T]:
+    if isinstance(items, AsyncIterable):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+class WorkerPool[T, R]:
+    """
+    Run func over a lazy (async) iterable with a fixed, but adjustable, number of workers.
+
+    Items are only pulled from the iterable when a worker is free and results are yielded as soon as they complete,
+    so neither the inputs nor the results pile up in memory. By default the first exception cancels the remaining work
+    and is raised; with return_exceptions=True it becomes the result of its item and the other items carry on.
+    Cancelling the consumer (e.g. Ctrl-C) cancels the workers and waits for them to clean up.
+    """
+
+    def __init__(self, workers: int, func: Callable[[T], Awaitable[R]], return_exceptions: bool = False):
+        self.workers = max(1, workers)
+        self.func = func
+        self.return_exceptions = return_exceptions
+        self._tasks: set[asyncio.Task] = set()
+        self._source: AsyncIterator[T] | None = None
+        self._source_lock = asyncio.Lock()
+        self._results: asyncio.Queue | None = None
+        self._exhausted = False
+        self._error: BaseException | None = None
+
+    def resize(self, workers: int):
+        """Change the number of workers. Extra workers exit after their current item."""
+        self.workers = max(1, workers)
+        if self._results is not None:
+            self._spawn()
+
+    def _spawn(self):
+        while len(self._tasks) < self.workers and not self._exhausted:
+            self._tasks.add(asyncio.create_task(self._worker()))
+
+    async def _next_item(self) -> T:
+        # Async generators can't be advanced concurrently
+        async with self._source_lock:
+            if self._exhausted:
+                raise StopAsyncIteration
+            try:
+                return await anext(self._source)
+            except StopAsyncIteration:
+                self._exhausted = True
+                raise
+
+    async def _worker(self):
+        try:
+            while len(self._tasks) <= self.workers:
+                try:
+                    item = await self._next_item()
+                except StopAsyncIteration:
+                    break
+                try:
+                    result = await self.func(item)
+                except Exception as e:
+                    if not self.return_exceptions:
+                        raise
+                    result = e
+                await self._results.put((item, result))
+        except Exception as e:
+            self._error = self._error or e
+        finally:
+            self._tasks.discard(asyncio.current_task())
+
+        if not self._tasks or self._error:
+            await self._results.put(_DONE)
+
+    async def map(self, items: Iterable[T] | AsyncIterable[T]) -> AsyncIterator[tuple[T, R | Exception]]:
+        """Yield (item, result) pairs in completion order."""
+        self._source = _aiter(items)
+        self._results = asyncio.Queue(maxsize=self.workers)
+        self._exhausted = False
+        self._error = None
+        try:
+            self._spawn()
+            while self._tasks or not self._results.empty():
+                entry = await self._results.get()
+                if self._error:
+                    raise self._error
+                if entry is _DONE:
+                    continue
+                yield entry
+        finally:
+            tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._tasks.clear()
+            self._results = None
+            await self._source.aclose()
+
+    async def run(self, items: Iterable[T] | AsyncIterable[T]) -> list[tuple[T, Exception]]:
+        """Process every item, discarding the results. Returns the failed items (with return_exceptions=True)."""
+        failures = []
+        async with aclosing(self.map(items)) as results:
+            async for item, result in results:
+                if self.return_exceptions and isinstance(result, Exception):
+                    tqdm.write(f"Error processing {item!r}: {result!r}")
+                    failures.append((item, result))
+        if failures:
+            tqdm.write(f"{len(failures)} items failed")
+        return failures
@@ -0,0 +1,18 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Number of processes used for CPU-bound parsing
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", os.process_cpu_count() or 1))
+
+_executor: ProcessPoolExecutor | None = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """Process pool shared by the parsing stages, created on first use."""
+    global _executor
+    if _executor is None:
+        # By then the event loop runs alongside the aiofiles and download writer threads, which forking would copy in
+        # whatever state they are in
+        _executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+    return _executor
@@ -0,0 +1,200 @@
+"""
+Indexed store for what broken_links learns while rescuing files: potential results ((lowercased file name, size) ->
+URL), Memento timegate answers and DuckDuckGo searches.
+
+Entries are written as they are found, so an interrupted run keeps everything it learned. The potential_results.json,
+memento_cache.json and search_cache.json files of the data directory are merged into the store whenever they change,
+and export_json writes them back to share them.
+"""
+
+import os
+import sqlite3
+from typing import Iterable
+
+from tqdm import tqdm
+
+from . import json
+from .paths import data_dir, work_dir
+
+_db_path = work_dir / "rescue_cache.sqlite"
+_db: sqlite3.Connection | None = None
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS potential_results (
+    name TEXT NOT NULL,
+    size TEXT NOT NULL,
+    url TEXT NOT NULL,
+    PRIMARY KEY (name, size)
+);
+
+-- An empty archive_url means the timegate has no copy
+CREATE TABLE IF NOT EXISTS memento_cache (
+    url TEXT PRIMARY KEY,
+    archive_url TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS search_cache (
+    query TEXT PRIMARY KEY,
+    results BLOB NOT NULL
+);
+
+-- Modification time of the JSON files when they were last imported or exported
+CREATE TABLE IF NOT EXISTS json_files (
+    name TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+);
+"""
+
+potential_results_path = data_dir / "potential_results.json"
+memento_cache_path = data_dir / "memento_cache.json"
+search_cache_path = data_dir / "search_cache.json"
+
+
+def _get_db() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(_db_path, isolation_level=None, timeout=30)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.executescript(_SCHEMA)
+        import_json()
+    return _db
+
+
+def _transaction(db: sqlite3.Connection, sql: str, rows: Iterable[tuple]):
+    db.execute("BEGIN")
+    try:
+        db.executemany(sql, rows)
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+
+
+def _dump_results(results: list[dict[str, str]]) -> bytes:
+    data = json.dumps(results)
+    return data.encode() if isinstance(data, str) else data
+
+
+def find_potential_results(name: str) -> dict[str, str]:
+    """{size: URL} of the known files with this (lowercased) name, in the order they were found."""
+    rows = _get_db().execute("SELECT size, url FROM potential_results WHERE name = ? ORDER BY rowid", (name,))
+    return dict(rows.fetchall())
+
+
+def add_potential_results(entries: Iterable[tuple[str, int | str, str]]):
+    """Record (name, size, URL) entries; the name is lowercased."""
+    _transaction(
+        _get_db(),
+        "INSERT INTO potential_results (name, size, url) VALUES (?, ?, ?) "
+        "ON CONFLICT (name, size) DO UPDATE SET url = excluded.url",
+        ((name.lower(), str(size), url) for name, size, url in entries),
+    )
+
+
+def get_memento(url: str) -> str | None:
+    """The archived copy of url, "" if the timegate has none, or None if it wasn't asked yet."""
+    row = _get_db().execute("SELECT archive_url FROM memento_cache WHERE url = ?", (url,)).fetchone()
+    return row[0] if row else None
+
+
+def put_memento(url: str, archive_url: str):
+    _get_db().execute("INSERT OR REPLACE INTO memento_cache (url, archive_url) VALUES (?, ?)", (url, archive_url))
+
+
+def get_search(query: str) -> list[dict[str, str]] | None:
+    row = _get_db().execute("SELECT results FROM search_cache WHERE query = ?", (query,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def put_search(query: str, results: list[dict[str, str]]):
+    _get_db().execute(
+        "INSERT OR REPLACE INTO search_cache (query, results) VALUES (?, ?)", (query, _dump_results(results))
+    )
+
+
+def _import_potential_results(obj: dict[str, dict[str, str]]) -> int:
+    entries = [(name, size, url) for name, files in obj.items() for size, url in files.items()]
+    add_potential_results(tqdm(entries, desc="Importing potential results", unit="entry"))
+    return len(entries)
+
+
+def _import_memento_cache(obj: dict[str, str]) -> int:
+    _transaction(_get_db(), "INSERT OR REPLACE INTO memento_cache (url, archive_url) VALUES (?, ?)", obj.items())
+    return len(obj)
+
+
+def _import_search_cache(obj: dict[str, list[dict[str, str]]]) -> int:
+    _transaction(
+        _get_db(),
+        "INSERT OR REPLACE INTO search_cache (query, results) VALUES (?, ?)",
+        ((query, _dump_results(results)) for query, results in obj.items()),
+    )
+    return len(obj)
+
+
+def import_json() -> dict[str, int]:
+    """
+    Merge the JSON files of the data directory that changed since they were last imported or exported into the store.
+    Returns the number of entries imported per file.
+    """
+    db = _get_db()
+    counts = {}
+    for path, importer in (
+        (potential_results_path, _import_potential_results),
+        (memento_cache_path, _import_memento_cache),
+        (search_cache_path, _import_search_cache),
+    ):
+        if not path.is_file():
+            continue
+        mtime = path.stat().st_mtime
+        row = db.execute("SELECT mtime FROM json_files WHERE name = ?", (path.name,)).fetchone()
+        if row and row[0] == mtime:
+            continue
+        with open(path, "rb") as f:
+            counts[path.name] = importer(json.load(f))
+        db.execute("INSERT OR REPLACE INTO json_files (name, mtime) VALUES (?, ?)", (path.name, mtime))
+    return counts
+
+
+def export_json() -> dict[str, int]:
+    """Write the store back to the JSON files of the data directory. Returns the number of entries per file."""
+    db = _get_db()
+
+    potential_results: dict[str, dict[str, str]] = {}
+    for name, size, url in db.execute("SELECT name, size, url FROM potential_results ORDER BY rowid"):
+        potential_results.setdefault(name, {})[size] = url
+    memento_cache = dict(db.execute("SELECT url, archive_url FROM memento_cache ORDER BY rowid"))
+    rows = db.execute("SELECT query, results FROM search_cache ORDER BY rowid")
+    search_cache = {query: json.loads(results) for query, results in rows}
+
+    for path, obj in (
+        (potential_results_path, potential_results),
+        (memento_cache_path, memento_cache),
+        (search_cache_path, search_cache),
+    ):
+        # Write to a temporary file first, so an interrupted export doesn't leave a truncated file behind
+        tmp = path.with_name(f"{path.name}.tmp")
+        with open(tmp, "wb") as f:
+            json.dump(obj, f)
+        tmp.replace(path)
+        db.execute("INSERT OR REPLACE INTO json_files (name, mtime) VALUES (?, ?)", (path.name, path.stat().st_mtime))
+
+    return {
+        potential_results_path.name: len(potential_results),
+        memento_cache_path.name: len(memento_cache),
+        search_cache_path.name: len(search_cache),
+    }
+
+
+def compact() -> tuple[int, int]:
+    """Reclaim the space of overwritten entries. Returns the size of the store before and after, in bytes."""
+
+    def size() -> int:
+        return sum(os.path.getsize(p) for p in (_db_path, f"{_db_path}-wal") if os.path.exists(p))
+
+    db = _get_db()
+    before = size()
+    db.execute("VACUUM")
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return before, size()
@@ -0,0 +1,174 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable
+
+from tqdm import tqdm
+
+# Jobs at least this large are considered large and only get a share of the workers
+LARGE_JOB_SIZE = 50 * 1024 * 1024
+LARGE_SHARE = 0.5
+
+
+def parse_rate(value: str | None) -> float | None:
+    """Parse a byte rate such as 500K, 20M or 1.5G (per second)."""
+    if not value:
+        return None
+    multipliers = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    value = value.strip().upper().removesuffix("B").removesuffix("/S")
+    if value and value[-1] in multipliers:
+        return float(value[:-1]) * multipliers[value[-1]]
+    return float(value)
+
+
+class TokenBucket:
+    """Byte-rate limiter shared by all downloads. Consumers may go into debt and then wait for it to be repaid."""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    async def consume(self, amount: int):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+# DOWNLOAD_RATE_LIMIT=20M caps the total download bandwidth to 20 MiB/s
+_rate = parse_rate(os.environ.get("DOWNLOAD_RATE_LIMIT"))
+bandwidth = TokenBucket(_rate) if _rate else None
+
+
+async def throttle_bandwidth(amount: int):
+    if bandwidth is not None:
+        await bandwidth.consume(amount)
+
+
+@dataclass(order=True)
+class _Job:
+    priority: tuple
+    item: Any = field(compare=False)
+    size: int = field(compare=False)
+
+
+class _Lane:
+    def __init__(self):
+        self.small: list[_Job] = []
+        self.large: list[_Job] = []
+
+    def __bool__(self):
+        return bool(self.small or self.large)
+
+
+class SizeAwareScheduler:
+    """
+    Run jobs of known (or unknown) size with a fixed number of workers.
+
+    Jobs are split into one lane per host, and lanes are served round-robin so a slow host can't take every worker.
+    Within a lane small jobs are started smallest first, while large ones are started largest first but, across all
+    lanes, may only occupy LARGE_SHARE of the workers, so a handful of huge packages never blocks thousands of small
+    files. When nothing but large jobs is queued they may use every worker rather than leave them idle; small jobs
+    submitted after that wait for one of them to finish. Progress and ETA are reported in bytes.
+
+    Jobs can be submitted while run() is already processing them. With max_pending set, submit() waits while that many
+    jobs are queued, so a producer can stream an unbounded number of jobs in constant memory; the ordering above then
+    applies within the queued window.
+    """
+
+    def __init__(self, workers: int, desc: str = "Downloading", max_pending: int | None = None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.lanes: dict[str, _Lane] = {}
+        self._order = itertools.count()
+        self._rr = itertools.count()
+        self._closed = False
+        lock = asyncio.Lock()
+        self._cond = asyncio.Condition(lock)
+        self._space = asyncio.Condition(lock)
+        self.pending = 0
+        self.large_running = 0
+        self.progress = tqdm(total=0, desc=desc, unit="B", unit_scale=True, unit_divisor=1024)
+        self.jobs_total = 0
+        self.jobs_done = 0
+
+    async def submit(self, item: Any, size: int | None, host: str):
+        async with self._cond:
+            while self.max_pending and self.pending >= self.max_pending:
+                await self._space.wait()
+
+            lane = self.lanes.setdefault(host, _Lane())
+            size = size or 0
+            if size >= LARGE_JOB_SIZE:
+                heapq.heappush(lane.large, _Job((-size, next(self._order)), item, size))
+            else:
+                # Unknown sizes go after the known small ones
+                heapq.heappush(lane.small, _Job((size == 0, size, next(self._order)), item, size))
+
+            self.pending += 1
+            self.jobs_total += 1
+            self.progress.total += size
+            self.progress.refresh()
+            self._cond.notify()
+
+    async def close(self):
+        """Signal that no more jobs will be submitted."""
+        async with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _pick(self) -> _Job | None:
+        lanes = [lane for lane in self.lanes.values() if lane]
+        if not lanes:
+            return None
+        start = next(self._rr)
+        large_allowed = self.large_running < max(1, int(self.workers * LARGE_SHARE))
+        for i in range(len(lanes)):
+            lane = lanes[(start + i) % len(lanes)]
+            if lane.large and large_allowed:
+                self.large_running += 1
+                return heapq.heappop(lane.large)
+            if lane.small:
+                return heapq.heappop(lane.small)
+        # Only large jobs are queued and their share is taken, let them use the idle workers
+        lane = lanes[start % len(lanes)]
+        self.large_running += 1
+        return heapq.heappop(lane.large)
+
+    async def _next(self) -> _Job | None:
+        async with self._cond:
+            while True:
+                picked = self._pick()
+                if picked:
+                    self.pending -= 1
+                    self._space.notify()
+                    return picked
+                if self._closed:
+                    return None
+                await self._cond.wait()
+
+    async def run(self, func: Callable[[Any], Awaitable[Any]]):
+        """Process jobs until close() is called and every submitted job is done."""
+
+        async def worker():
+            while job := await self._next():
+                try:
+                    await func(job.item)
+                finally:
+                    if job.size >= LARGE_JOB_SIZE:
+                        self.large_running -= 1
+                    self.jobs_done += 1
+                    self.progress.update(job.size)
+                    self.progress.set_postfix_str(f"{self.jobs_done}/{self.jobs_total} items", refresh=False)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(self.workers)))
+        finally:
+            self.progress.close()
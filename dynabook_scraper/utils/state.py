@@ -0,0 +1,502 @@
+import hashlib
+import os
+import sqlite3
+import time
+from typing import Any, Iterable, Iterator
+
+from tqdm import tqdm
+
+from . import json
+from .paths import content_dir, work_dir
+
+_db_path = work_dir / "state.sqlite"
+# Number of rows fetched at once by the iterators
+PAGE_SIZE = 1000
+_db: sqlite3.Connection | None = None
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS contents (
+    cid TEXT PRIMARY KEY,
+    content_type TEXT NOT NULL,
+    content_file TEXT,
+    file_size INTEGER,
+    details BLOB NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS contents_content_type ON contents (content_type);
+CREATE INDEX IF NOT EXISTS contents_updated_at ON contents (updated_at);
+
+CREATE TABLE IF NOT EXISTS results (
+    cid TEXT PRIMARY KEY,
+    status_code INTEGER NOT NULL,
+    mirror_hostname TEXT,
+    rescue_strategy TEXT,
+    actual_size INTEGER,
+    result BLOB NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_status_code ON results (status_code);
+CREATE INDEX IF NOT EXISTS results_updated_at ON results (updated_at);
+
+-- When the details of each content were last fetched, see ContentDownloader.download_contents(max_age)
+CREATE TABLE IF NOT EXISTS detail_fetches (
+    cid TEXT PRIMARY KEY,
+    fetched_at REAL NOT NULL
+);
+
+-- Contents linked from the details of each content, as of the details' updated_at, see gather_content_links
+CREATE TABLE IF NOT EXISTS content_links (
+    cid TEXT PRIMARY KEY,
+    details_updated_at REAL NOT NULL,
+    links TEXT NOT NULL
+);
+
+-- Inputs of each generated products/<mid>.json, see product_index
+CREATE TABLE IF NOT EXISTS product_manifest (
+    mid TEXT PRIMARY KEY,
+    inputs_stat TEXT NOT NULL,
+    inputs_hash TEXT NOT NULL,
+    generated_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS product_contents (
+    mid TEXT NOT NULL,
+    cid TEXT NOT NULL,
+    PRIMARY KEY (mid, cid)
+);
+CREATE INDEX IF NOT EXISTS product_contents_cid ON product_contents (cid);
+
+-- Contents each dynabook-scrape-*-contents stage still has to (or already did) fetch the details of, so that an
+-- interrupted run can resume. status is pending, done or failed; failed contents are retried by the next run of the
+-- stage. All but the failed ones are cleared when a run of the stage completes.
+CREATE TABLE IF NOT EXISTS content_frontier (
+    stage TEXT NOT NULL,
+    cid TEXT NOT NULL,
+    content_type TEXT NOT NULL,
+    sor TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    PRIMARY KEY (stage, cid)
+);
+
+-- Location of each scraped page in the work/html pack files, see html_pack
+CREATE TABLE IF NOT EXISTS html_pages (
+    mid TEXT NOT NULL,
+    name TEXT NOT NULL,
+    pack TEXT NOT NULL,
+    pack_offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    codec TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (mid, name)
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+"""
+
+
+def _get_db() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        created = not _db_path.is_file()
+        _db = sqlite3.connect(_db_path, isolation_level=None, timeout=30)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.executescript(_SCHEMA)
+        if created and any(name.endswith(".json") for name in os.listdir(content_dir)):
+            # Data directory from before the state database existed
+            import_json(_db)
+    return _db
+
+
+def _decode(blob: bytes | str) -> dict[str, Any]:
+    return json.loads(blob)
+
+
+def _encode(obj: dict[str, Any]) -> bytes:
+    data = json.dumps(obj)
+    return data.encode() if isinstance(data, str) else data
+
+
+def _put_details(db: sqlite3.Connection, details: dict[str, Any], updated_at: float):
+    # Rows are only touched when something changed, so that updated_at can drive incremental exports
+    db.execute(
+        """
+        INSERT INTO contents (cid, content_type, content_file, file_size, details, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (cid) DO UPDATE SET
+            content_type = excluded.content_type,
+            content_file = excluded.content_file,
+            file_size = excluded.file_size,
+            details = excluded.details,
+            updated_at = excluded.updated_at
+        WHERE details != excluded.details
+        """,
+        (
+            str(details["contentID"]),
+            details["contentType"],
+            details.get("contentFile"),
+            details.get("fileSize"),
+            _encode(details),
+            updated_at,
+        ),
+    )
+
+
+def _put_result(db: sqlite3.Connection, result: dict[str, Any], updated_at: float):
+    db.execute(
+        """
+        INSERT INTO results (cid, status_code, mirror_hostname, rescue_strategy, actual_size, result, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (cid) DO UPDATE SET
+            status_code = excluded.status_code,
+            mirror_hostname = excluded.mirror_hostname,
+            rescue_strategy = excluded.rescue_strategy,
+            actual_size = excluded.actual_size,
+            result = excluded.result,
+            updated_at = excluded.updated_at
+        WHERE result != excluded.result
+        """,
+        (
+            str(result["contentID"]),
+            result["status_code"],
+            result.get("mirror_hostname"),
+            result.get("rescue_strategy"),
+            result.get("actual_size"),
+            _encode(result),
+            updated_at,
+        ),
+    )
+
+
+def put_details(details: dict[str, Any]):
+    _put_details(_get_db(), details, time.time())
+
+
+def put_result(result: dict[str, Any]):
+    _put_result(_get_db(), result, time.time())
+
+
+def get_details(cid: str | int) -> dict[str, Any] | None:
+    row = _get_db().execute("SELECT details FROM contents WHERE cid = ?", (str(cid),)).fetchone()
+    return _decode(row[0]) if row else None
+
+
+def get_result(cid: str | int) -> dict[str, Any] | None:
+    row = _get_db().execute("SELECT result FROM results WHERE cid = ?", (str(cid),)).fetchone()
+    return _decode(row[0]) if row else None
+
+
+def set_details_fetched(cid: str | int, fetched_at: float | None = None):
+    _get_db().execute(
+        "INSERT OR REPLACE INTO detail_fetches (cid, fetched_at) VALUES (?, ?)", (str(cid), fetched_at or time.time())
+    )
+
+
+def fresh_details(since: float) -> set[str]:
+    """Contents whose markup-fixed details were fetched after since."""
+    rows = _get_db().execute(
+        """
+        SELECT f.cid FROM detail_fetches f JOIN contents c USING (cid)
+        WHERE f.fetched_at >= ? AND json_extract(CAST(c.details AS TEXT), '$.markup_fixed')
+        """,
+        (since,),
+    )
+    return {cid for (cid,) in rows}
+
+
+def delete_result(cid: str | int):
+    db = _get_db()
+    db.execute("DELETE FROM results WHERE cid = ?", (str(cid),))
+    # Let the products referencing this content notice the change
+    db.execute("UPDATE contents SET updated_at = ? WHERE cid = ?", (time.time(), str(cid)))
+    # Don't leave a stale exported copy behind
+    (content_dir / f"{cid}_crawl_result.json").unlink(missing_ok=True)
+
+
+def content_ids() -> list[str]:
+    return [cid for (cid,) in _get_db().execute("SELECT cid FROM contents ORDER BY cid")]
+
+
+def count_contents() -> int:
+    return _get_db().execute("SELECT COUNT(*) FROM contents").fetchone()[0]
+
+
+def count_unscanned_links() -> int:
+    rows = _get_db().execute(
+        """
+        SELECT COUNT(*) FROM contents c LEFT JOIN content_links l USING (cid)
+        WHERE l.details_updated_at IS NULL OR l.details_updated_at != c.updated_at
+        """
+    )
+    return rows.fetchone()[0]
+
+
+def iter_unscanned_links() -> Iterator[list[tuple[str, str, float]]]:
+    """
+    Yield pages of (cid, serialized details, updated_at) for the contents whose links weren't found since their details
+    last changed.
+    """
+    query = f"""
+        SELECT c.cid, c.details, c.updated_at FROM contents c LEFT JOIN content_links l USING (cid)
+        WHERE c.cid > ? AND (l.details_updated_at IS NULL OR l.details_updated_at != c.updated_at)
+        ORDER BY c.cid LIMIT {PAGE_SIZE}
+        """
+    last = ""
+    while rows := _get_db().execute(query, (last,)).fetchall():
+        last = rows[-1][0]
+        yield [(cid, details.decode() if isinstance(details, bytes) else details, at) for cid, details, at in rows]
+
+
+def put_content_links(entries: Iterable[tuple[str, float, Iterable[str]]]):
+    """Record the (cid, details updated_at, linked cids) found by gather_content_links."""
+    db = _get_db()
+    db.execute("BEGIN")
+    try:
+        db.executemany(
+            "INSERT OR REPLACE INTO content_links (cid, details_updated_at, links) VALUES (?, ?, ?)",
+            ((cid, updated_at, " ".join(sorted(links))) for cid, updated_at, links in entries),
+        )
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+
+
+def all_content_links() -> set[str]:
+    links = set()
+    for (row,) in _get_db().execute("SELECT links FROM content_links WHERE links != ''"):
+        links.update(row.split(" "))
+    return links
+
+
+def iter_contents(
+    content_types: Iterable[str] | None = None,
+) -> Iterator[tuple[dict[str, Any], dict[str, Any] | None]]:
+    """
+    Yield (details, crawl result or None) for every content, optionally only of the given types.
+
+    Rows are fetched in pages, so that no statement stays open while the caller writes to the database.
+    """
+    query = "SELECT c.cid, c.details, r.result FROM contents c LEFT JOIN results r USING (cid) WHERE c.cid > ?"
+    params = ()
+    if content_types is not None:
+        params = tuple(content_types)
+        query += f" AND c.content_type IN ({', '.join('?' * len(params))})"
+    query += f" ORDER BY c.cid LIMIT {PAGE_SIZE}"
+
+    last = ""
+    while rows := _get_db().execute(query, (last, *params)).fetchall():
+        for last, details, result in rows:
+            yield _decode(details), _decode(result) if result is not None else None
+
+
+def iter_results() -> Iterator[dict[str, Any]]:
+    """Yield every crawl result, fetched in pages like iter_contents so the caller can write results meanwhile."""
+    last = ""
+    query = f"SELECT cid, result FROM results WHERE cid > ? ORDER BY cid LIMIT {PAGE_SIZE}"
+    while rows := _get_db().execute(query, (last,)).fetchall():
+        for last, result in rows:
+            yield _decode(result)
+
+
+def failed_contents(content_types: Iterable[str]) -> list[dict[str, Any]]:
+    """Details of the contents of the given types whose last crawl did not succeed."""
+    content_types = tuple(content_types)
+    placeholders = ", ".join("?" * len(content_types))
+    # Written as a range so that the status index can be used
+    rows = _get_db().execute(
+        f"""
+        SELECT c.details FROM results r JOIN contents c USING (cid)
+        WHERE (r.status_code < 200 OR r.status_code > 200) AND c.content_type IN ({placeholders})
+        """,
+        content_types,
+    )
+    return [_decode(details) for (details,) in rows]
+
+
+def get_product_manifest(mid: str) -> tuple[str, str] | None:
+    """(inputs_stat, inputs_hash) recorded when products/<mid>.json was last generated."""
+    return _get_db().execute("SELECT inputs_stat, inputs_hash FROM product_manifest WHERE mid = ?", (mid,)).fetchone()
+
+
+def put_product_manifest(mid: str, inputs_stat: str, inputs_hash: str, cids: Iterable[str] | None = None):
+    """Record the inputs of a product payload, and the contents it references unless cids is None."""
+    db = _get_db()
+    db.execute("BEGIN")
+    try:
+        db.execute(
+            "INSERT OR REPLACE INTO product_manifest (mid, inputs_stat, inputs_hash, generated_at) VALUES (?, ?, ?, ?)",
+            (mid, inputs_stat, inputs_hash, time.time()),
+        )
+        if cids is not None:
+            db.execute("DELETE FROM product_contents WHERE mid = ?", (mid,))
+            db.executemany(
+                "INSERT OR IGNORE INTO product_contents (mid, cid) VALUES (?, ?)", ((mid, str(cid)) for cid in cids)
+            )
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+
+
+def products_with_changed_contents(since: float) -> set[str]:
+    """Products referencing a content whose details or crawl result changed after since."""
+    rows = _get_db().execute(
+        """
+        SELECT DISTINCT p.mid FROM product_contents p
+        WHERE p.cid IN (
+            SELECT cid FROM contents WHERE updated_at > ? UNION SELECT cid FROM results WHERE updated_at > ?
+        )
+        """,
+        (since, since),
+    )
+    return {mid for (mid,) in rows}
+
+
+def add_to_frontier(stage: str, entries: Iterable[tuple[str, str, str | None]]):
+    """Add (cid, content_type, sor) entries to the frontier of a stage, ignoring those already in it."""
+    db = _get_db()
+    db.execute("BEGIN")
+    try:
+        db.executemany(
+            "INSERT OR IGNORE INTO content_frontier (stage, cid, content_type, sor) VALUES (?, ?, ?, ?)",
+            ((stage, *entry) for entry in entries),
+        )
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+
+
+def mark_frontier_done(stage: str, cid: str, failed: bool = False):
+    _get_db().execute(
+        "UPDATE content_frontier SET status = ? WHERE stage = ? AND cid = ?",
+        ("failed" if failed else "done", stage, cid),
+    )
+
+
+def get_frontier(stage: str) -> list[tuple[str, str, str | None, str]]:
+    """(cid, content_type, sor, status) of every content in the frontier of a stage, in insertion order."""
+    rows = _get_db().execute(
+        "SELECT cid, content_type, sor, status FROM content_frontier WHERE stage = ? ORDER BY rowid", (stage,)
+    )
+    return rows.fetchall()
+
+
+def clear_frontier(stage: str):
+    """Forget the contents of the frontier of a stage, except the failed ones."""
+    _get_db().execute("DELETE FROM content_frontier WHERE stage = ? AND status != 'failed'", (stage,))
+
+
+def put_html_page(mid: str, name: str, pack: str, offset: int, length: int, codec: str, digest: str):
+    _get_db().execute(
+        "INSERT OR REPLACE INTO html_pages (mid, name, pack, pack_offset, length, codec, digest) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (mid, name, pack, offset, length, codec, digest),
+    )
+
+
+def get_html_page(mid: str, name: str) -> tuple[str, int, int, str, str] | None:
+    """(pack, offset, length, codec, digest) of a packed page."""
+    rows = _get_db().execute(
+        "SELECT pack, pack_offset, length, codec, digest FROM html_pages WHERE mid = ? AND name = ?", (mid, name)
+    )
+    return rows.fetchone()
+
+
+def html_page_names(mid: str) -> list[str]:
+    return [name for (name,) in _get_db().execute("SELECT name FROM html_pages WHERE mid = ? ORDER BY name", (mid,))]
+
+
+def html_page_positions(name: str) -> dict[str, tuple[str, int]]:
+    """{mid: (pack, offset)} of the given page of every product."""
+    rows = _get_db().execute("SELECT mid, pack, pack_offset FROM html_pages WHERE name = ?", (name,))
+    return {mid: (pack, offset) for mid, pack, offset in rows}
+
+
+def get_meta(key: str) -> Any:
+    row = _get_db().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set_meta(key: str, value: Any):
+    _get_db().execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+
+def fingerprint() -> str:
+    """Changes whenever any content details or crawl result is written."""
+    db = _get_db()
+    contents = db.execute("SELECT COUNT(*), MAX(updated_at) FROM contents").fetchone()
+    results = db.execute("SELECT COUNT(*), MAX(updated_at) FROM results").fetchone()
+    return f"{contents[0]}:{contents[1]}:{results[0]}:{results[1]}"
+
+
+def failures_fingerprint() -> str:
+    """Changes only when the set of failed contents, or their status, changes."""
+    hasher = hashlib.sha256()
+    for cid, status_code in _get_db().execute(
+        "SELECT cid, status_code FROM results WHERE status_code < 200 OR status_code > 200 ORDER BY cid"
+    ):
+        hasher.update(f"{cid}:{status_code}\n".encode())
+    return hasher.hexdigest()
+
+
+def import_json(db: sqlite3.Connection | None = None) -> tuple[int, int]:
+    """Load the per-content JSON files of content_dir into the database. Returns the number of (details, results)."""
+    db = db or _get_db()
+    now = time.time()
+    counts = [0, 0]
+    db.execute("BEGIN")
+    try:
+        for name in tqdm(os.listdir(content_dir), desc="Importing crawl state", unit="file"):
+            if not name.endswith(".json"):
+                continue
+            with open(content_dir / name, "rb") as f:
+                obj = json.load(f)
+            if name.endswith("_crawl_result.json"):
+                _put_result(db, obj, now)
+                counts[1] += 1
+            elif "contentID" in obj:
+                _put_details(db, obj, now)
+                # The file was written when the details were fetched
+                db.execute(
+                    "INSERT OR IGNORE INTO detail_fetches (cid, fetched_at) VALUES (?, ?)",
+                    (str(obj["contentID"]), os.stat(content_dir / name).st_mtime),
+                )
+                counts[0] += 1
+        # Everything imported is already on disk
+        set_meta("exported_at", now)
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    return counts[0], counts[1]
+
+
+def export_json(full: bool = False) -> tuple[int, int]:
+    """
+    Write the <cid>.json and <cid>_crawl_result.json files served by the frontend.
+
+    Only rows changed since the previous export are written, unless full is set. Returns the number of (details,
+    results) written.
+    """
+    db = _get_db()
+    since = 0.0 if full else get_meta("exported_at") or 0.0
+    now = time.time()
+
+    counts = [0, 0]
+    for i, (table, column, suffix) in enumerate(
+        (("contents", "details", ".json"), ("results", "result", "_crawl_result.json"))
+    ):
+        total = db.execute(f"SELECT COUNT(*) FROM {table} WHERE updated_at >= ?", (since,)).fetchone()[0]
+        rows = db.execute(f"SELECT cid, {column} FROM {table} WHERE updated_at >= ?", (since,))
+        for cid, blob in tqdm(rows, total=total, desc=f"Exporting {table}", unit="file"):
+            with open(content_dir / f"{cid}{suffix}", "wb") as f:
+                f.write(blob.encode() if isinstance(blob, str) else blob)
+            counts[i] += 1
+
+    set_meta("exported_at", now)
+    return counts[0], counts[1]
@@ -0,0 +1,99 @@
+import asyncio
+import email.utils
+import time
+
+from tqdm import tqdm
+
+# Start conservatively, the limit will grow as long as the host stays healthy
+INITIAL_LIMIT = 4
+MIN_LIMIT = 1
+# Multiplicative decrease applied on 429/5xx and connection errors
+BACKOFF_FACTOR = 0.5
+# A request is considered slow when its latency exceeds the baseline by this factor
+SLOW_FACTOR = 3.0
+# Weight of new samples in the latency moving average
+EWMA_ALPHA = 0.2
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class HostThrottle:
+    """
+    AIMD concurrency controller for a single host.
+
+    The number of requests allowed in flight grows by roughly one every time a full window of requests completes
+    with healthy latency, and is halved when the host answers with 429/5xx or drops connections. A Retry-After
+    header pauses every worker hitting the host until it expires.
+    """
+
+    def __init__(self, host: str, max_limit: int):
+        self.host = host
+        self.max_limit = max(max_limit, MIN_LIMIT)
+        self.limit = float(min(INITIAL_LIMIT, self.max_limit))
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.latency: float | None = None
+        self.baseline: float | None = None
+        self._last_backoff = 0.0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), pause)
+                    except TimeoutError:
+                        pass
+                    continue
+                if self.in_flight < int(self.limit):
+                    break
+                await self._cond.wait()
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_response(self, status: int, latency: float, retry_after: str | None = None):
+        if status == 429 or status >= 500:
+            self.on_error(parse_retry_after(retry_after))
+        else:
+            self.on_success(latency)
+
+    def on_success(self, latency: float):
+        self.latency = latency if self.latency is None else (1 - EWMA_ALPHA) * self.latency + EWMA_ALPHA * latency
+        self.baseline = latency if self.baseline is None else min(self.baseline, latency)
+
+        if self.latency > self.baseline * SLOW_FACTOR:
+            # The host is getting slower, stop growing and let the average settle
+            self.baseline *= 1.01
+            return
+
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_error(self, retry_after: float | None = None):
+        now = time.monotonic()
+        if retry_after:
+            if self.paused_until <= now:
+                tqdm.write(f"{self.host} asked to retry after {retry_after:.0f}s, pausing all workers")
+            self.paused_until = max(self.paused_until, now + retry_after)
+
+        # Only back off once per round-trip, since all requests in flight will likely fail together
+        if now - self._last_backoff > (self.latency or 1.0):
+            self._last_backoff = now
+            self.limit = max(MIN_LIMIT, self.limit * BACKOFF_FACTOR)
@@ -1,3 +1,7 @@
+import asyncio
+
+from .http import close_session
+
 try:
     # noinspection PyUnresolvedReferences
     import uvloop
@@ -7,8 +11,15 @@ except ImportError:
     uvloop_available = False
 
 
-def async_run(*a, **kw):
+async def _run_with_session(coro):
+    try:
+        return await coro
+    finally:
+        await close_session()
+
+
+def async_run(coro, *a, **kw):
     if uvloop_available:
-        return uvloop.run(*a, **kw)
+        return uvloop.run(_run_with_session(coro), *a, **kw)
     else:
-        return asyncio.run(*a, **kw)
+        return asyncio.run(_run_with_session(coro), *a, **kw)
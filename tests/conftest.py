@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# dynabook_scraper.utils.paths creates its directories on import, keep them out of the working tree
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="dynabook-tests-"))
+os.environ.pop("HTTP_UPSTREAM_OVERRIDE", None)
+os.environ.setdefault("TQDM_DISABLE", "1")
+sys.path.insert(0, str(Path(__file__).parent.parent))
@@ -0,0 +1,71 @@
+"""Smoke run of every dynabook-* entry point against the fake upstream, in pipeline order."""
+
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+from benchmarks.pipeline import ORCHESTRATED, ROOT, STAGES, entry_points, run_stage, wait_for_port
+
+
+def _first_content_id(data_dir) -> str:
+    return min(p.stem for p in (data_dir / "content").glob("*.json") if not p.stem.endswith("_crawl_result"))
+
+
+def _first_mid(data_dir) -> str:
+    return min(p.stem for p in (data_dir / "products").glob("*.json"))
+
+
+# (script, arguments or a function of the data directory returning them), after the pipeline stages
+EXTRA_STAGES = [
+    ("dynabook-scrape-all-contents", []),
+    ("dynabook-download-content", lambda data_dir: [_first_content_id(data_dir)]),
+    ("dynabook-pack-html", []),
+    ("dynabook-unpack-html", lambda data_dir: [_first_mid(data_dir), str(data_dir / "unpacked")]),
+    ("dynabook-export-rescue-cache", []),
+    ("dynabook-compact-rescue-cache", []),
+    ("dynabook-dedupe-downloads", []),
+    ("dynabook-import-state", []),
+    *ORCHESTRATED,
+]
+
+
+def test_every_entry_point_is_smoke_tested():
+    assert {script for script, _ in STAGES + EXTRA_STAGES} == set(entry_points())
+
+
+@pytest.fixture(scope="module")
+def pipeline_env(tmp_path_factory):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    upstream = subprocess.Popen(
+        [sys.executable, str(ROOT / "benchmarks/fake_upstream.py"), "--port", str(port), "--models", "3"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port)
+        data_dir = tmp_path_factory.mktemp("data")
+        env = os.environ | {
+            "DATA_DIR": str(data_dir),
+            "HTTP_UPSTREAM_OVERRIDE": f"http://127.0.0.1:{port}",
+            "TQDM_DISABLE": "1",
+            "PYTHONPATH": str(ROOT),
+        }
+        yield data_dir, env
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+@pytest.mark.parametrize(("script", "args"), STAGES + EXTRA_STAGES, ids=[script for script, _ in STAGES + EXTRA_STAGES])
+def test_entry_point(pipeline_env, script, args):
+    data_dir, env = pipeline_env
+    if callable(args):
+        args = args(data_dir)
+    with open(data_dir / f"{script}.log", "w") as log:
+        code, _, _ = run_stage(script, entry_points()[script], args, env, log)
+    assert code == 0, (data_dir / f"{script}.log").read_text()[-2000:]
@@ -0,0 +1,59 @@
+import pytest
+
+from dynabook_scraper.content_details import Content, ContentDownloader
+from dynabook_scraper.utils import state
+
+
+def test_listing_replaces_link_placeholder():
+    added = []
+    downloader = ContentDownloader(on_added=added.append)
+    downloader.ingest_link("12345")
+    downloader.ingest({"contentID": "12345", "contentType": "SB", "sor": None})
+
+    assert downloader.contents["12345"] == Content("12345", "SB", "undefined")
+    # Fetched again with its actual type
+    assert [c.contentType for c in added] == ["DL", "SB"]
+
+
+def test_link_does_not_replace_listing():
+    downloader = ContentDownloader()
+    downloader.ingest({"contentID": "12345", "contentType": "SB"})
+    downloader.ingest_link("12345")
+    assert downloader.contents["12345"].contentType == "SB"
+
+
+def test_conflicting_listings_still_raise():
+    downloader = ContentDownloader()
+    downloader.ingest({"contentID": "12345", "contentType": "SB"})
+    with pytest.raises(ValueError):
+        downloader.ingest({"contentID": "12345", "contentType": "DL", "sor": "abc"})
+
+
+def test_content_listed_as_two_kinds_is_fetched_once():
+    added = []
+    downloader = ContentDownloader(on_added=added.append)
+    downloader.ingest({"contentID": 12345, "contentType": "DL", "sor": "abc"}, "drivers")
+    downloader.ingest({"contentID": "12345", "contentType": "UG", "sor": "def"}, "manuals and specs")
+
+    assert downloader.contents["12345"] == Content("12345", "DL", "abc")
+    assert added == [Content("12345", "DL", "abc")]
+    with pytest.raises(ValueError):
+        downloader.ingest({"contentID": "12345", "contentType": "DL", "sor": "xyz"}, "drivers")
+
+
+def test_frontier_is_kept_per_stage_and_retries_failures():
+    state.add_to_frontier("drivers", [("1", "DL", None), ("2", "DL", None)])
+    state.add_to_frontier("kb", [("3", "SB", None)])
+    state.mark_frontier_done("drivers", "1")
+    state.mark_frontier_done("drivers", "2", failed=True)
+
+    downloader = ContentDownloader()
+    downloader._stage = "drivers"
+    downloader._resume()
+    assert set(downloader.contents) == {"1", "2"}
+    assert downloader.downloaded_ids == {"1"}
+
+    state.clear_frontier("drivers")
+    assert state.get_frontier("drivers") == [("2", "DL", None, "failed")]
+    assert state.get_frontier("kb") == [("3", "SB", None, "pending")]
+    state.clear_frontier("kb")
@@ -0,0 +1,103 @@
+import asyncio
+import hashlib
+
+import pytest
+from aiohttp import web
+
+from dynabook_scraper.utils import download, http
+from dynabook_scraper.utils.paths import data_dir
+
+FILE_SIZE = 3 * 1024 * 1024 + 123
+
+
+def _payload(name: str) -> bytes:
+    block = hashlib.sha256(name.encode()).digest() * 4096
+    return (block * (FILE_SIZE // len(block) + 1))[:FILE_SIZE]
+
+
+async def _serve(honor_ranges: bool, chunk_delay: float = 0) -> tuple[web.AppRunner, str]:
+    async def handle(request: web.Request) -> web.StreamResponse:
+        body = _payload(request.match_info["name"])
+        headers = {"Accept-Ranges": "bytes"}
+        status = 200
+        range_header = request.headers.get("Range")
+        if range_header and honor_ranges:
+            first, _, last = range_header.removeprefix("bytes=").partition("-")
+            start, end = int(first), int(last) if last else len(body) - 1
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+            status, body = 206, body[start : end + 1]
+        if not chunk_delay:
+            return web.Response(status=status, body=body, headers=headers)
+
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = len(body)
+        await response.prepare(request)
+        for i in range(0, len(body), 64 * 1024):
+            await response.write(body[i : i + 64 * 1024])
+            await asyncio.sleep(chunk_delay)
+        return response
+
+    app = web.Application()
+    app.router.add_get("/{name}", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner, f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+
+async def _download_all(honor_ranges: bool, count: int, out: str):
+    runner, base_url = await _serve(honor_ranges)
+    try:
+        names = [f"file{i}.bin" for i in range(count)]
+        coros = [download.download_file(f"{base_url}/{name}", data_dir / out) for name in names]
+        results = await asyncio.wait_for(asyncio.gather(*coros), timeout=30)
+    finally:
+        await http.close_session()
+        await runner.cleanup()
+    for name, result in zip(names, results):
+        assert (data_dir / out / name).read_bytes() == _payload(name)
+        assert result["sha256"] == hashlib.sha256(_payload(name)).hexdigest()
+
+
+@pytest.fixture(autouse=True)
+def small_segments(monkeypatch):
+    monkeypatch.setattr(download, "SEGMENT_THRESHOLD", 1024 * 1024)
+
+
+def test_segmented_downloads_beyond_host_limit():
+    # More large files than the initial per-host limit used to deadlock, each parent holding a slot
+    asyncio.run(_download_all(honor_ranges=True, count=8, out="segmented"))
+
+
+def test_segments_fall_back_to_single_stream():
+    asyncio.run(_download_all(honor_ranges=False, count=2, out="single"))
+
+
+async def _interrupt_segmented_download(keep_progress: bool) -> bytes:
+    out_dir = data_dir / f"interrupted-{keep_progress}"
+    part = out_dir / "file.bin.segmented.part"
+    runner, base_url = await _serve(honor_ranges=True, chunk_delay=0.02)
+    try:
+        task = asyncio.create_task(download.download_file(f"{base_url}/file.bin", out_dir))
+        while not part.is_file() or part.stat().st_size == 0:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert part.stat().st_size == FILE_SIZE
+        if not keep_progress:
+            # As if the process had been killed before saving the progress of the segments
+            (out_dir / "file.bin.segmented.part.segments").unlink()
+
+        result = await asyncio.wait_for(download.download_file(f"{base_url}/file.bin", out_dir), timeout=30)
+    finally:
+        await http.close_session()
+        await runner.cleanup()
+    assert result["sha256"] == hashlib.sha256(_payload("file.bin")).hexdigest()
+    return (out_dir / "file.bin").read_bytes()
+
+
+@pytest.mark.parametrize("keep_progress", [True, False])
+def test_interrupted_segmented_download(keep_progress):
+    assert asyncio.run(_interrupt_segmented_download(keep_progress)) == _payload("file.bin")
@@ -0,0 +1,51 @@
+import asyncio
+import hashlib
+
+import aiohttp
+import pytest
+
+from dynabook_scraper import fix_markup
+from dynabook_scraper.utils import blobstore
+from dynabook_scraper.utils.paths import data_dir
+
+IMAGE = b"\x89PNG banner"
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    """Stand-in for download_file failing on the first request, then storing the image."""
+    requests = []
+
+    async def download_file(url, out_dir, out_filename):
+        requests.append(url)
+        await asyncio.sleep(0.01)
+        if len(requests) == 1:
+            raise aiohttp.ClientConnectionError("reset")
+        digest = hashlib.sha256(IMAGE).hexdigest()
+        out_dir.mkdir(exist_ok=True, parents=True)
+        (out_dir / out_filename).write_bytes(IMAGE)
+        blobstore.store(out_dir / out_filename, digest)
+        return {"sha256": digest}
+
+    monkeypatch.setattr(fix_markup, "download_file", download_file)
+    return requests
+
+
+async def _fetch_twice(url: str) -> list[list[bool]]:
+    results = []
+    for attempt in range(2):
+        dests = [data_dir / "images" / str(attempt) / f"{i}.png" for i in range(3)]
+        results.append(await asyncio.gather(*(fix_markup.fetch_image(url, dest) for dest in dests)))
+    return results
+
+
+def test_failed_image_is_retried(downloads):
+    url = "https://support.dynabook.com/images/banner.png"
+    with pytest.warns(UserWarning):
+        first, second = asyncio.run(_fetch_twice(url))
+
+    # The contents waiting for the failed fetch share its failure, the next ones fetch the image again, once
+    assert first == [False, False, False]
+    assert second == [True, True, True]
+    assert downloads == [url, url]
+    assert (data_dir / "images" / "1" / "2.png").read_bytes() == IMAGE
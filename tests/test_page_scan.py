@@ -0,0 +1,25 @@
+import bs4
+import pytest
+
+from dynabook_scraper.utils.page_scan import find_model_img
+
+PAGES = [
+    '<div class="model_img"><img src="a.png"></div><img src="other.png">',
+    '<div class="box model_img wide"><div class="frame"></div><div><img src="nested.png"></div></div>',
+    '<div class="model_img"><div><div></div></div></div><img src="outside.png">',
+    '<div class="model_img"></div><p class="model_img"><span><img src=\'second.png\'></span></p>',
+    '<img class="model_img" src="self.png"><div class="model_img"><img src="x&amp;y.png"></div>',
+    '<DIV class="model_img"><Div></DIV><img src="case.png"></DIV>',
+    '<p>model_img</p><div class="model_img"><br/><img alt="" src="after-text.png"></div>',
+    "<div>no image here</div>",
+]
+
+
+def _legacy(page: str) -> str | None:
+    img = bs4.BeautifulSoup(page, "html.parser").select_one(".model_img img")
+    return img["src"] if img else None
+
+
+@pytest.mark.parametrize("page", PAGES)
+def test_find_model_img_matches_beautifulsoup(page):
+    assert find_model_img(page.encode()) == _legacy(page)
@@ -0,0 +1,42 @@
+import asyncio
+
+from dynabook_scraper.utils.scheduler import LARGE_JOB_SIZE, SizeAwareScheduler
+
+
+async def _run(jobs: list[tuple[str, int, str]], workers: int) -> list[tuple[str, int]]:
+    """Run jobs of (name, size, host), returning (name, number of large jobs running) as each one starts."""
+    scheduler = SizeAwareScheduler(workers)
+    started = []
+    running_large = 0
+
+    async def func(job):
+        nonlocal running_large
+        name, size = job
+        large = size >= LARGE_JOB_SIZE
+        running_large += large
+        started.append((name, running_large))
+        await asyncio.sleep(0.01)
+        running_large -= large
+
+    for name, size, host in jobs:
+        await scheduler.submit((name, size), size, host)
+    await scheduler.close()
+    await scheduler.run(func)
+    return started
+
+
+def test_large_share_is_global():
+    jobs = [(f"large-{host}-{i}", LARGE_JOB_SIZE * (i + 1), host) for host in "abcd" for i in range(3)]
+    jobs += [(f"small-{host}-{i}", 1024, host) for host in "abcd" for i in range(20)]
+    started = asyncio.run(_run(jobs, workers=8))
+
+    assert len(started) == len(jobs)
+    # Every lane has large jobs, still no more than half of the workers may run them while small ones are queued
+    last_small = max(i for i, (name, _) in enumerate(started) if name.startswith("small"))
+    assert max(running for _, running in started[: last_small + 1]) <= 4
+
+
+def test_large_jobs_use_idle_workers():
+    jobs = [(f"large-{i}", LARGE_JOB_SIZE, "a") for i in range(6)]
+    started = asyncio.run(_run(jobs, workers=6))
+    assert max(running for _, running in started) == 6